@@ -0,0 +1,86 @@
+import time
+import random
+import string
+import argparse
+import logging
+import pandas as pd
+import bsa_utils
+import utils
+
+COLUMNS = ["BNF_CODE", "BNF_DESCRIPTION", "CHEMICAL_SUBSTANCE_BNF_DESCR"]
+
+def make_frames(existing_rows, latest_rows, new_fraction, seed=1):
+    """
+    Synthetic EPD-shaped extracts: a historic frame of distinct rows, and a
+    latest month drawn from it with a fraction of new codes, descriptions
+    and substances mixed in.
+    """
+    rng = random.Random(seed)
+    letters = string.ascii_uppercase
+
+    def make_row(i):
+        chem = f"{letters[i % 26]}{(i // 26) % 10}"
+        code = f"{rng.randint(1, 23):02d}{rng.randint(1, 12):02d}{rng.randint(1, 9):02d}0{chem}{i:08d}"
+        return (code, f"Drug {i} {rng.randint(1, 500)}mg tablets", f"Substance {chem}{(i // 260) % 5000}")
+
+    existing = [make_row(i) for i in range(existing_rows)]
+    latest = [rng.choice(existing) for _ in range(latest_rows)]
+    for j in range(int(latest_rows * new_fraction)):
+        latest[j] = make_row(existing_rows + j)
+    return pd.DataFrame(existing, columns=COLUMNS), pd.DataFrame(latest, columns=COLUMNS)
+
+def set_difference(df_existing, df_latest):
+    # The previous implementation: Python sets of every value in each column
+    results = {}
+    for column in COLUMNS:
+        unique = set(df_latest[column]) - set(df_existing[column])
+        results[column] = df_latest[df_latest[column].isin(unique)]
+    utils.CompareLatest.find_unique_rows(results["BNF_DESCRIPTION"], results["BNF_CODE"])
+    return results
+
+def compare_latest(df_existing, df_latest, parallel=False):
+    compare = utils.CompareLatest(df_existing, df_latest, parallel=parallel)
+    return {
+        "BNF_CODE": compare.new_bnf_codes,
+        "BNF_DESCRIPTION": compare.new_bnf_descriptions,
+        "CHEMICAL_SUBSTANCE_BNF_DESCR": compare.new_chem_subs,
+    }
+
+def time_engine(engine, df_existing, df_latest, repeat):
+    best, results = None, None
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        results = engine(df_existing, df_latest)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the utils.CompareLatest diff against Python set differences.")
+    parser.add_argument("--existing-rows", type=int, default=2000000, help="Rows in the historic extract.")
+    parser.add_argument("--latest-rows", type=int, default=200000, help="Rows in the latest month.")
+    parser.add_argument("--new-fraction", type=float, default=0.001, help="Fraction of latest rows that are new.")
+    parser.add_argument("--string-dtype", choices=bsa_utils.STRING_DTYPES, default="object", help="Storage for string columns.")
+    parser.add_argument("--parallel", action="store_true", help="Compare the key columns in separate threads.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per engine; the fastest is reported.")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    df_existing, df_latest = make_frames(args.existing_rows, args.latest_rows, args.new_fraction)
+    df_existing = bsa_utils.convert_string_columns(df_existing, args.string_dtype)
+    df_latest = bsa_utils.convert_string_columns(df_latest, args.string_dtype)
+
+    baseline_seconds, expected = time_engine(set_difference, df_existing, df_latest, args.repeat)
+    engine = lambda existing, latest: compare_latest(existing, latest, parallel=args.parallel)
+    engine_seconds, results = time_engine(engine, df_existing, df_latest, args.repeat)
+    for column in COLUMNS:
+        if not results[column].index.equals(expected[column].index):
+            raise AssertionError(f"CompareLatest disagrees with the set difference for {column}")
+
+    print(f"{'engine':>16} {'seconds':>9} {'speed-up':>9}")
+    print(f"{'set difference':>16} {baseline_seconds:>9.3f} {1:>9.1f}")
+    print(f"{'CompareLatest':>16} {engine_seconds:>9.3f} {baseline_seconds / engine_seconds:>9.1f}")
+    print(", ".join(f"{column}: {len(results[column])} new rows" for column in COLUMNS))
+
+if __name__ == "__main__":
+    main()
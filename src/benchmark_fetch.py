@@ -0,0 +1,77 @@
+import time
+import argparse
+import logging
+import tempfile
+import bsa_utils
+import ckan_stub
+
+def run_fetch(stub, workers):
+    # Start each run cold so package metadata is not served from an earlier run
+    with tempfile.TemporaryDirectory() as cache_dir:
+        bsa_utils.PACKAGE_METADATA_CACHE = bsa_utils.PackageMetadataCache(cache_dir=cache_dir, ttl=0)
+        return time_fetch(stub, workers)
+
+def time_fetch(stub, workers):
+    sql = (
+        "SELECT DISTINCT "
+        "BNF_PRESENTATION_CODE AS BNF_CODE, "
+        "BNF_PRESENTATION_NAME AS BNF_DESCRIPTION, "
+        "BNF_CHEMICAL_SUBSTANCE AS CHEMICAL_SUBSTANCE_BNF_DESCR "
+        "{FROM_TABLE} "
+    )
+    with stub.patched_endpoint():
+        start = time.perf_counter()
+        fetch = bsa_utils.FetchData(
+            resource=stub.fixtures.package_id, sql=sql, date_from="earliest", date_to="latest",
+            max_workers=workers
+        )
+        elapsed = time.perf_counter() - start
+    raw_rows = sum(len(stub.fixtures.resources[name]) for name in fetch.resource_list)
+    return {
+        "workers": workers,
+        "seconds": elapsed,
+        "raw_rows": raw_rows,
+        "distinct_rows": fetch.count_results(),
+        "rows_per_second": raw_rows / elapsed if elapsed else float("inf"),
+        "failed": len(fetch.return_failed_resources()),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark bsa_utils.FetchData against a local CKAN stand-in.")
+    parser.add_argument("--months", type=int, default=12, help="Number of monthly resources.")
+    parser.add_argument("--rows", type=int, default=20000, help="Rows per resource.")
+    parser.add_argument("--truncate-at", type=int, default=5000, help="Serve results above this many rows as gzipped CSV shards.")
+    parser.add_argument("--shards", type=int, default=2, help="Number of gc_urls shards for truncated results.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8], help="Worker counts to compare.")
+    parser.add_argument("--latency", type=float, default=0.2, help="Mean added latency per datastore request, in seconds.")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of datastore requests answered with 429.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of datastore requests answered with 503.")
+    parser.add_argument("--requests-per-second", type=float, default=None, help="Override the shared API rate limit.")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per worker count; the fastest is reported.")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.requests_per_second:
+        bsa_utils.API_RATE_LIMITER = bsa_utils.RateLimiter(args.requests_per_second, max(1, int(args.requests_per_second)))
+
+    fixtures = ckan_stub.StubFixtures(months=args.months, rows_per_resource=args.rows)
+    stub = ckan_stub.CKANStub(
+        fixtures, latency=args.latency, throttle_rate=args.throttle_rate, error_rate=args.error_rate,
+        retry_after=0, truncate_at=args.truncate_at, shards=args.shards
+    ).start()
+
+    print(f"{'workers':>8} {'seconds':>9} {'raw rows':>10} {'distinct':>10} {'rows/s':>12} {'failed':>7}")
+    try:
+        for workers in args.workers:
+            runs = [run_fetch(stub, workers) for _ in range(max(1, args.repeat))]
+            best = min(runs, key=lambda run: run["seconds"])
+            print(
+                f"{best['workers']:>8} {best['seconds']:>9.2f} {best['raw_rows']:>10} "
+                f"{best['distinct_rows']:>10} {best['rows_per_second']:>12.0f} {best['failed']:>7}"
+            )
+    finally:
+        stub.stop()
+    print(f"Requests served: {stub.counters}")
+
+if __name__ == "__main__":
+    main()
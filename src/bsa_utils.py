@@ -1,14 +1,26 @@
 import os
+import re
+import json
+import hashlib
 import sqlite3
 import requests
+import numpy as np
 import pandas as pd
 import gzip
-import io
+import csv
+import tempfile
 import urllib.parse
 from datetime import datetime
 import logging
 import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
 import warnings
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
 warnings.simplefilter("ignore", category=UserWarning)
 
@@ -22,8 +34,27 @@ class Config:
         self.base_endpoint = 'https://opendata.nhsbsa.net/api/3/action/'
         self.package_list_method = 'package_list'
         self.package_show_method = 'package_show?id='
+        self.package_search_method = 'package_search?'
         self.action_method = 'datastore_search_sql?'
 
+        # Concurrency and connection pooling for API requests
+        self.max_workers = 4
+        self.pool_size = 16
+        self.request_timeout = 120
+
+        # Rate limiting and retries for the CKAN API
+        self.requests_per_second = 5
+        self.rate_limit_burst = 5
+        self.retry_base_delay = 1
+        self.retry_max_delay = 60
+
+        # Streaming download of truncated results
+        self.download_chunk_size = 1024 * 1024
+        self.csv_block_size = 16 * 1024 * 1024
+
+        # Seconds package metadata is trusted before it is revalidated
+        self.metadata_ttl = 60 * 60
+
         # Create data directory if it doesn't exist
         self.DATA_DIR = os.path.join(os.getcwd(), "data")
 
@@ -34,6 +65,335 @@ class Config:
 
 CONFIG_OBJ = Config()
 
+def safe_file_name(name):
+    # Resource and package ids as file names
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", name)
+
+class ParquetStore:
+    """
+    A DataFrame saved as parquet with a JSON sidecar of metadata, such as the
+    caches and indexes kept under CONFIG_OBJ.DATA_DIR. Both files are written
+    to temporary names and swapped in, so a failed run cannot leave a partial
+    entry. The store is only ever a cache: unreadable entries are ignored and
+    failed writes are logged, never raised.
+    """
+    def __init__(self, directory, name):
+        self.directory = directory
+        self.data_path = os.path.join(directory, f"{name}.parquet")
+        self.meta_path = os.path.join(directory, f"{name}.json")
+
+    def load_meta(self):
+        try:
+            with open(self.meta_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logging.warning(f"Ignoring unreadable {self.meta_path}: {e}")
+            return None
+
+    def load_data(self):
+        try:
+            return pd.read_parquet(self.data_path)
+        except (OSError, ValueError, pa.ArrowException) as e:
+            if not isinstance(e, FileNotFoundError):
+                logging.warning(f"Ignoring unreadable {self.data_path}: {e}")
+            return None
+
+    def load(self):
+        """
+        Return (df, meta), or (None, None) if there is no readable entry.
+        """
+        meta = self.load_meta()
+        df = self.load_data() if meta is not None else None
+        return (df, meta) if df is not None else (None, None)
+
+    def save(self, df, meta):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            df.to_parquet(f"{self.data_path}.tmp", index=False)
+            with open(f"{self.meta_path}.tmp", "w") as f:
+                json.dump(meta, f, indent=2)
+            os.replace(f"{self.data_path}.tmp", self.data_path)
+            os.replace(f"{self.meta_path}.tmp", self.meta_path)
+            return True
+        except (OSError, ValueError, pa.ArrowException) as e:
+            logging.warning(f"Could not write {self.data_path}: {e}")
+            return False
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """
+    Return the shared requests.Session, creating it on first use so that
+    every API call in the process reuses the same connection pool.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=CONFIG_OBJ.pool_size, pool_maxsize=CONFIG_OBJ.pool_size)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+class RateLimiter:
+    """
+    Token bucket limiting the rate of API requests across all workers.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+API_RATE_LIMITER = RateLimiter(CONFIG_OBJ.requests_per_second, CONFIG_OBJ.rate_limit_burst)
+
+class AdaptiveConcurrency:
+    """
+    Limits the number of requests in flight, adjusting the limit AIMD-style:
+    it grows by roughly one per window of successful requests and halves
+    whenever the API throttles us.
+    """
+    def __init__(self, maximum, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= max(self.minimum, int(self.limit)):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, outcome):
+        with self.condition:
+            self.in_flight -= 1
+            if outcome == "throttled":
+                self.limit = max(self.minimum, self.limit / 2)
+                logging.warning(f"API throttling detected, concurrency reduced to {int(self.limit)}")
+            elif outcome == "success":
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+class RetryPolicy:
+    """
+    Decides whether a failed request is retried and how long to wait first.
+    Throttling (429) and server errors (5xx) are retried, honouring any
+    Retry-After header; other client errors are not.
+    """
+    def __init__(self, max_attempts, base_delay=None, max_delay=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay if base_delay is not None else CONFIG_OBJ.retry_base_delay
+        self.max_delay = max_delay if max_delay is not None else CONFIG_OBJ.retry_max_delay
+
+    @staticmethod
+    def is_retryable(status_code):
+        return status_code in (408, 429) or status_code >= 500
+
+    @staticmethod
+    def parse_retry_after(value):
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, retry_at.timestamp() - time.time())
+
+    def delay(self, attempt, retry_after=None):
+        # Honour the server's request, otherwise use exponential backoff with full jitter
+        requested = self.parse_retry_after(retry_after)
+        if requested is not None:
+            return min(requested, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+STRING_DTYPES = ["object", "pyarrow", "category"]
+
+def pandas_string_dtype(string_dtype):
+    """
+    Return the pandas dtype to load string columns as, or None to keep the
+    default Python object columns.
+    """
+    if string_dtype == "pyarrow":
+        return pd.StringDtype("pyarrow")
+    return None
+
+def plain_string_columns(df):
+    """
+    Convert Arrow-backed string and categorical columns back to Python object
+    columns with None for missing values, the form data is persisted in so it
+    does not depend on the string dtype of the run that wrote it.
+    """
+    columns = [
+        col for col in df.columns
+        if isinstance(df[col].dtype, (pd.StringDtype, pd.CategoricalDtype))
+    ]
+    if not columns:
+        return df
+    df = df.copy()
+    for col in columns:
+        df[col] = df[col].astype(object).where(df[col].notna(), None)
+    return df
+
+def convert_string_columns(df, string_dtype="object", columns=None):
+    """
+    Convert string columns to Arrow-backed strings ("pyarrow") or dictionary
+    encoded categoricals ("category"). "object" leaves the frame unchanged.
+    """
+    if string_dtype not in STRING_DTYPES:
+        raise ValueError(f"Unknown string dtype '{string_dtype}'. Expected one of {STRING_DTYPES}.")
+    if df is None or string_dtype == "object":
+        return df
+    if columns is None:
+        columns = [col for col in df.columns if df[col].dtype == object or isinstance(df[col].dtype, pd.StringDtype)]
+    target = pandas_string_dtype(string_dtype) if string_dtype == "pyarrow" else "category"
+    conversions = {col: target for col in columns if col in df.columns and df[col].dtype != target}
+    if not conversions:
+        return df
+    return df.astype(conversions)
+
+class PackageMetadataCache:
+    """
+    Process-wide cache of package_show results, persisted under the data
+    directory. Once the TTL has passed an entry is revalidated against the
+    package's metadata_modified (and HTTP validators) before being refetched.
+    """
+    def __init__(self, cache_dir=None, ttl=None):
+        self.cache_dir = cache_dir if cache_dir else os.path.join(CONFIG_OBJ.DATA_DIR, "metadata_cache")
+        self.ttl = ttl if ttl is not None else CONFIG_OBJ.metadata_ttl
+        self.entries = {}
+        self.resources_tables = {}
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def entry_path(self, package_id):
+        return os.path.join(self.cache_dir, f"{safe_file_name(package_id)}.json")
+
+    def load_entry(self, package_id):
+        if package_id in self.entries:
+            return self.entries[package_id]
+        try:
+            with open(self.entry_path(package_id), "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self.entries[package_id] = entry
+        return entry
+
+    def save_entry(self, package_id, entry):
+        self.entries[package_id] = entry
+        path = self.entry_path(package_id)
+        try:
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(entry, f)
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            logging.warning(f"Could not persist metadata for package {package_id}: {e}")
+
+    @staticmethod
+    def fetch_metadata_modified(package_id):
+        """
+        Ask package_search for only the package's metadata_modified, which is a
+        far smaller response than package_show with its full resource list.
+        """
+        query = urllib.parse.urlencode({"fq": f'name:"{package_id}"', "fl": "metadata_modified", "rows": 1})
+        response = get_session().get(
+            f"{CONFIG_OBJ.base_endpoint}{CONFIG_OBJ.package_search_method}{query}",
+            timeout=CONFIG_OBJ.request_timeout
+        )
+        response.raise_for_status()
+        results = response.json()['result']['results']
+        return results[0].get('metadata_modified') if results else None
+
+    def revalidate(self, package_id, entry):
+        try:
+            metadata_modified = self.fetch_metadata_modified(package_id)
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logging.warning(f"Could not revalidate metadata for package {package_id}: {e}")
+            return False
+        return metadata_modified is not None and metadata_modified == entry.get('metadata_modified')
+
+    def fetch_package(self, package_id, entry):
+        """
+        Fetch package_show, sending any stored HTTP validators. Returns None if
+        the server reports the cached entry as not modified.
+        """
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        response = get_session().get(
+            f"{CONFIG_OBJ.base_endpoint}{CONFIG_OBJ.package_show_method}{package_id}",
+            headers=headers,
+            timeout=CONFIG_OBJ.request_timeout
+        )
+        if response.status_code == 304 and entry:
+            return None
+        response.raise_for_status()  # Ensure the request was successful
+        result = response.json()['result']
+        return {
+            'metadata_modified': result.get('metadata_modified'),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'result': result,
+        }
+
+    def get(self, package_id):
+        with self.lock:
+            entry = self.load_entry(package_id)
+            now = time.time()
+            if entry and now - entry.get('checked_at', 0) < self.ttl:
+                return entry['result']
+
+            if entry and self.revalidate(package_id, entry):
+                logging.info(f"Metadata for package {package_id} is unchanged.")
+            else:
+                new_entry = self.fetch_package(package_id, entry)
+                if new_entry is None:
+                    logging.info(f"Metadata for package {package_id} not modified.")
+                else:
+                    entry = new_entry
+
+            entry['checked_at'] = now
+            self.save_entry(package_id, entry)
+            return entry['result']
+
+    def get_resources_table(self, package_id):
+        """
+        Return the package's resources as a DataFrame, normalising the resource
+        list only once per published version of the package metadata.
+        """
+        result = self.get(package_id)
+        key = (package_id, result.get('metadata_modified'))
+        with self.lock:
+            if key not in self.resources_tables:
+                self.resources_tables = {k: v for k, v in self.resources_tables.items() if k[0] != package_id}
+                self.resources_tables[key] = pd.json_normalize(result['resources'])
+            return self.resources_tables[key].copy()
+
+PACKAGE_METADATA_CACHE = PackageMetadataCache()
+
 class ResourceNames:
     """
     Handles fetching and filtering resource names based on date ranges.
@@ -51,10 +411,7 @@ class ResourceNames:
             self.resource_name_list_filter()
 
     def get_resource_names(self):
-        response = requests.get(f"{CONFIG_OBJ.base_endpoint}{CONFIG_OBJ.package_show_method}{self.resource}")
-        response.raise_for_status()  # Ensure the request was successful
-        metadata_response = response.json()
-        self.resources_table = pd.json_normalize(metadata_response['result']['resources'])
+        self.resources_table = PACKAGE_METADATA_CACHE.get_resources_table(self.resource)
         self.resources_table['date'] = pd.to_datetime(
             self.resources_table['bq_table_name'].str.extract(r'(\d{6})')[0], format='%Y%m', errors='coerce'
         )
@@ -121,7 +478,8 @@ class ResourceNames:
 
         filtered_df = filtered_df.copy()
         
-        self.resource_name_list = list(set(filtered_df['bq_table_name'].tolist()))
+        # Sorted so that requests (and their results) follow a deterministic order
+        self.resource_name_list = sorted(set(filtered_df['bq_table_name'].dropna().tolist()))
         self.date_list = filtered_df['date'].tolist()
 
     def return_latest_resource(self):
@@ -130,6 +488,18 @@ class ResourceNames:
         latest_table_name = self.resources_table[self.resources_table['date'] == latest_date]['bq_table_name'].values[0]
         return latest_date
     
+    def return_resource_metadata(self, bq_table_name):
+        """
+        Return the package_show fields that identify a published version of a
+        resource, used to invalidate cached results when the resource changes.
+        """
+        fields = ['id', 'last_modified', 'metadata_modified', 'size', 'hash']
+        rows = self.resources_table[self.resources_table['bq_table_name'] == bq_table_name]
+        if rows.empty:
+            return {}
+        row = rows.iloc[0]
+        return {field: str(row[field]) for field in fields if field in row.index and pd.notna(row[field])}
+
     def return_date_list(self):
         return self.date_list
     
@@ -164,24 +534,173 @@ class APICall:
         )
     
 
+class ResultCache:
+    """
+    On-disk cache of per-resource query results, keyed by resource id and
+    normalised SQL and stored as parquet under the data directory.
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir if cache_dir else os.path.join(CONFIG_OBJ.DATA_DIR, "result_cache")
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def normalise_sql(sql):
+        return re.sub(r"\s+", " ", sql).strip().rstrip(";").strip()
+
+    def cache_key(self, resource_id, sql):
+        key_source = f"{resource_id}\n{self.normalise_sql(sql)}"
+        return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+    def store(self, resource_id, sql):
+        return ParquetStore(self.cache_dir, self.cache_key(resource_id, sql))
+
+    def get(self, resource_id, sql, resource_metadata):
+        if not resource_metadata:
+            return None
+        store = self.store(resource_id, sql)
+        meta = store.load_meta()
+        if meta is None:
+            return None
+        if meta.get("resource_metadata") != resource_metadata:
+            logging.info(f"Cached results for resource {resource_id} are out of date.")
+            return None
+        return store.load_data()
+
+    def put(self, resource_id, sql, resource_metadata, df):
+        if not resource_metadata:
+            return
+        self.store(resource_id, sql).save(df, {
+            "resource_id": resource_id,
+            "sql": self.normalise_sql(sql),
+            "resource_metadata": resource_metadata,
+            "rows": len(df),
+            "cached_at": datetime.now().isoformat(timespec="seconds"),
+        })
+
+class FetchCheckpoint:
+    """
+    Records which resources of a multi-resource fetch have completed, so an
+    interrupted fetch can be resumed without repeating them. The results
+    themselves live in a ResultCache: the fetch's own cache when it has one,
+    otherwise one kept with the checkpoint.
+    """
+    def __init__(self, resource, sql, resume=False, checkpoint_dir=None, result_cache=None):
+        key = hashlib.sha256(f"{resource}\n{ResultCache.normalise_sql(sql)}".encode("utf-8")).hexdigest()[:16]
+        base_dir = checkpoint_dir if checkpoint_dir else os.path.join(CONFIG_OBJ.DATA_DIR, "checkpoints")
+        self.checkpoint_dir = os.path.join(base_dir, f"{safe_file_name(resource)}-{key}")
+        self.manifest_path = os.path.join(self.checkpoint_dir, "manifest.json")
+        self.sql = sql
+        # Results written by the fetch's own cache are not written again
+        self.shares_cache = result_cache is not None
+        self.result_cache = result_cache if result_cache else ResultCache(os.path.join(self.checkpoint_dir, "results"))
+        self.lock = threading.Lock()
+        self.manifest = None
+        if resume:
+            self.manifest = self.load_manifest()
+        if self.manifest is None:
+            self.reset(resource, sql)
+        else:
+            logging.info(f"Resuming fetch with {len(self.manifest['completed'])} completed resource(s)")
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_manifest(self):
+        with open(f"{self.manifest_path}.tmp", "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(f"{self.manifest_path}.tmp", self.manifest_path)
+
+    def reset(self, resource, sql):
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        if not self.shares_cache:
+            for filename in os.listdir(self.result_cache.cache_dir):
+                os.remove(os.path.join(self.result_cache.cache_dir, filename))
+        self.manifest = {"resource": resource, "sql": ResultCache.normalise_sql(sql), "completed": {}}
+        self.write_manifest()
+
+    def get(self, resource_id, resource_metadata):
+        entry = self.manifest["completed"].get(resource_id)
+        if entry is None or entry.get("resource_metadata") != resource_metadata:
+            return None
+        return self.result_cache.get(resource_id, self.sql, resource_metadata)
+
+    def save(self, resource_id, resource_metadata, df):
+        if not self.shares_cache:
+            self.result_cache.put(resource_id, self.sql, resource_metadata, df)
+        with self.lock:
+            self.manifest["completed"][resource_id] = {
+                "rows": len(df),
+                "resource_metadata": resource_metadata,
+                "completed_at": datetime.now().isoformat(timespec="seconds"),
+            }
+            self.write_manifest()
+
+class DistinctAccumulator:
+    """
+    Collects DataFrame chunks as they arrive, keeping only rows that have not
+    been seen before. Rows are tracked by a 64-bit hash of their values, held
+    in a sorted array, so memory grows with distinct rows rather than raw rows.
+    """
+    def __init__(self):
+        self.seen_hashes = np.empty(0, dtype=np.uint64)
+        self.chunks = []
+        self.columns = None
+        self.lock = threading.Lock()
+
+    def add(self, df):
+        if df is None or len(df.columns) == 0:
+            return
+        with self.lock:
+            if self.columns is None:
+                self.columns = list(df.columns)
+            elif list(df.columns) != self.columns:
+                df = df.reindex(columns=self.columns)
+            if df.empty:
+                return
+
+            hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+            keep = ~pd.Series(hashes).duplicated().to_numpy()
+            keep &= ~np.isin(hashes, self.seen_hashes, assume_unique=False)
+            if not keep.any():
+                return
+            self.seen_hashes = np.union1d(self.seen_hashes, hashes[keep])
+            self.chunks.append(df[keep])
+
+    def count(self):
+        return len(self.seen_hashes)
+
+    def result(self):
+        if not self.chunks:
+            return pd.DataFrame(columns=self.columns if self.columns else [])
+        return pd.concat(self.chunks, ignore_index=True)
+
 class FetchData:
     """
     Orchestrates the fetching of data from the API, including handling
     of API calls, and data processing.
     """
-    def __init__(self, resource, sql, date_from, date_to = False, max_attempts = 3):
+    def __init__(self, resource, sql, date_from, date_to = False, max_attempts = 3, max_workers = None, cache = False, string_dtype = "object", checkpoint = False, resume = False):
         logging.info(f"Initializing FetchData for resource: {resource} from {date_from} to {date_to if date_to else 'latest'}")
         self.resource = resource
         self.sql = sql
         self.max_attempts = max_attempts
+        self.max_workers = max_workers if max_workers else CONFIG_OBJ.max_workers
+        self.retry_policy = RetryPolicy(max_attempts)
+        self.concurrency = AdaptiveConcurrency(self.max_workers)
+        self.string_dtype = string_dtype
         self.resource_names_obj = ResourceNames(resource, date_from, date_to)
+        self.result_cache = ResultCache() if cache else None
+        self.checkpoint = FetchCheckpoint(resource, sql, resume=resume, result_cache=self.result_cache) if checkpoint or resume else None
         self.api_calls_list = []
-        self.returned_json_list = []
-        self.returned_df_list = []
+        self.accumulator = DistinctAccumulator()
         self.requests_map = []
         self.resource_list = []
+        self.failed_resources = {}
         self.full_results_df = None
-        self.returned_df = None
         self.generate_api_calls()
         self.generate_request_map()
         self.request_data()
@@ -194,66 +713,149 @@ class FetchData:
 
     def generate_request_map(self):
         for api_call in self.api_calls_list:
-            request_entry = {"resource_id": api_call.resource_id, "api_url": api_call.api_url}
+            request_entry = {"resource_id": api_call.resource_id, "api_url": api_call.api_url, "sql": api_call.sql}
             self.requests_map.append(request_entry)
             self.resource_list.append(api_call.resource_id)
 
     def request_data(self):
-        for resource in list(self.requests_map):
-            url = resource['api_url']
-            resource_id = resource['resource_id']
-            url_pending=True
-            retry_counter = 0
-            while url_pending and retry_counter <= self.max_attempts:       
-                try:
-                    logging.info(f"Requesting data for resource {resource_id}")
-                    response = requests.get(url, timeout=120)
-                    if response.status_code == 200:
-                        
-                        tmp_df = self.process_data(response.json())
-                        self.returned_df_list.append(tmp_df)
-                        
-                        logging.info(f"Success for {response.url}")
-                        url_pending = False  # Exit retry loop
-                    else:
-                        logging.error(f"Error {response.status_code} for {response.url}. Will retry.")
-                        retry_counter += 1
-                        time.sleep(2 ** retry_counter)  # Exponential backoff
-                except requests.RequestException as e:
-                    logging.error(f"Request error for {url}: {e}. Will retry.")
-                    retry_counter += 1
-                    time.sleep(2 ** retry_counter)  # Exponential backoff
+        workers = max(1, min(self.max_workers, len(self.requests_map)))
+        logging.info(f"Requesting {len(self.requests_map)} resources using {workers} worker(s)")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # map() yields results in submission order, so output is deterministic
+            for tmp_df in executor.map(self.request_resource, self.requests_map):
+                self.accumulator.add(tmp_df)
+
+        for resource_id, error in self.failed_resources.items():
+            logging.error(f"Failed to fetch resource {resource_id}: {error}")
+
+    def request_resource(self, resource):
+        url = resource['api_url']
+        resource_id = resource['resource_id']
+        resource_metadata = self.resource_names_obj.return_resource_metadata(resource_id)
+        if self.checkpoint:
+            checkpoint_df = self.checkpoint.get(resource_id, resource_metadata)
+            if checkpoint_df is not None:
+                logging.info(f"Skipping resource {resource_id}, already completed")
+                return checkpoint_df
+        if self.result_cache:
+            cached_df = self.result_cache.get(resource_id, resource['sql'], resource_metadata)
+            if cached_df is not None:
+                logging.info(f"Using cached results for resource {resource_id}")
+                return cached_df
+
+        session = get_session()
+        attempt = 0
+        last_error = None
+        while attempt <= self.max_attempts:
+            outcome = "error"
+            retry_after = None
+            retryable = True
+            self.concurrency.acquire()
+            try:
+                API_RATE_LIMITER.acquire()
+                logging.info(f"Requesting data for resource {resource_id}")
+                response = session.get(url, timeout=CONFIG_OBJ.request_timeout)
+                if response.status_code == 200:
+                    tmp_df = self.process_data(response.json())
+                    outcome = "success"
+                    logging.info(f"Success for resource {resource_id}")
+                    if self.result_cache:
+                        self.result_cache.put(resource_id, resource['sql'], resource_metadata, tmp_df)
+                    if self.checkpoint:
+                        self.checkpoint.save(resource_id, resource_metadata, tmp_df)
+                    return tmp_df
+                last_error = f"HTTP {response.status_code}"
+                retryable = self.retry_policy.is_retryable(response.status_code)
+                if response.status_code == 429:
+                    outcome = "throttled"
+                    retry_after = response.headers.get('Retry-After')
+                logging.error(f"Error {response.status_code} for resource {resource_id}.")
+            except (requests.RequestException, ValueError, KeyError) as e:
+                last_error = f"{type(e).__name__}: {e}"
+                logging.error(f"Request error for resource {resource_id}: {e}.")
+            finally:
+                self.concurrency.release(outcome)
+
+            attempt += 1
+            if not retryable or attempt > self.max_attempts:
+                break
+            delay = self.retry_policy.delay(attempt, retry_after)
+            logging.info(f"Retrying resource {resource_id} in {delay:.1f}s (attempt {attempt} of {self.max_attempts})")
+            time.sleep(delay)
+
+        self.failed_resources[resource_id] = last_error
+        return None
 
     def process_data(self, json_data):
+        accumulator = DistinctAccumulator()
         if 'records_truncated' in json_data['result'] and json_data['result']['records_truncated'] == 'true':
-            download_url = json_data['result']['gc_urls'][0]['url']
-            logging.info(f"Downloading truncated data from URL: {download_url}")
-            r = requests.get(download_url)
-            with gzip.open(io.BytesIO(r.content), 'rt') as f:
-                tmp_df = pd.read_csv(f)
+            # Large results are split across one or more gzipped CSV shards
+            for gc_url in json_data['result']['gc_urls']:
+                self.read_truncated_data(gc_url['url'], accumulator)
         else:
-            tmp_df = pd.json_normalize(json_data['result']['result']['records'])
+            accumulator.add(self.records_to_frame(json_data['result']['result']['records']))
 
-        tmp_df.drop_duplicates(inplace=True)
-        return tmp_df
-    
-    def join_results(self):
+        return accumulator.result()
+
+    @staticmethod
+    def records_to_frame(records):
+        """
+        JSON records as text columns, like the CSV shards. Numbers are kept as
+        their exact text, so 18-digit SNOMED ids never pass through float64
+        (which json_normalize uses for an integer column with a null).
+        """
+        df = pd.DataFrame(records, dtype=object)
+        return df.apply(lambda column: column.map(lambda value: value if value is None or isinstance(value, str) else str(value)))
+
+    @staticmethod
+    def read_truncated_data(download_url, accumulator):
+        """
+        Stream a gzipped CSV shard to a temporary file and parse it in record
+        batches into the accumulator, so memory use does not depend on the
+        size of the download.
+        """
+        logging.info(f"Downloading truncated data from URL: {download_url}")
+        fd, tmp_path = tempfile.mkstemp(suffix=".csv.gz", dir=CONFIG_OBJ.DATA_DIR)
         try:
-            if len(self.returned_df_list) > 0:
-                self.returned_df = pd.concat(self.returned_df_list)
-            if self.full_results_df is None or self.full_results_df.empty:
-                self.full_results_df = self.returned_df
-            else:
-                self.full_results_df = pd.concat([self.full_results_df, self.returned_df])
-            self.full_results_df = self.full_results_df.drop_duplicates()
-        except Exception as e:
-            logging.error(f"Error joining results: {e}")
-        
+            with os.fdopen(fd, 'wb') as tmp_file:
+                with get_session().get(download_url, stream=True, timeout=CONFIG_OBJ.request_timeout) as r:
+                    r.raise_for_status()
+                    for chunk in r.iter_content(chunk_size=CONFIG_OBJ.download_chunk_size):
+                        tmp_file.write(chunk)
+
+            with gzip.open(tmp_path, 'rt', newline='') as f:
+                column_names = next(csv.reader(f), [])
+            if not column_names:
+                return
+
+            # Codes and descriptions are identifiers, so read every column as a string
+            # rather than letting type inference on the first block decide
+            convert_options = pa_csv.ConvertOptions(
+                column_types={name: pa.string() for name in column_names},
+                strings_can_be_null=True
+            )
+            read_options = pa_csv.ReadOptions(block_size=CONFIG_OBJ.csv_block_size)
+            accumulator.add(pd.DataFrame(columns=column_names))
+            with pa.input_stream(tmp_path, compression='gzip') as stream:
+                reader = pa_csv.open_csv(stream, read_options=read_options, convert_options=convert_options)
+                for batch in reader:
+                    accumulator.add(batch.to_pandas())
+        finally:
+            os.remove(tmp_path)
+
+    def join_results(self):
+        # Rows were de-duplicated as they arrived, so this is a single concat
+        self.full_results_df = convert_string_columns(self.accumulator.result(), self.string_dtype)
+        logging.info(f"Collected {self.accumulator.count()} distinct rows.")
+
     def results(self):
         return self.full_results_df
     
     def count_results(self):
         return len(self.full_results_df)
+
+    def return_failed_resources(self):
+        return self.failed_resources
     
     def return_resources_from(self):
         # Given Timestamp
@@ -275,7 +877,10 @@ class FetchData:
 
 def show_available_datasets():
     # Extract list of datasets
-    datasets_response = requests.get(CONFIG_OBJ.base_endpoint +  CONFIG_OBJ.package_list_method).json()
+    datasets_response = get_session().get(
+        CONFIG_OBJ.base_endpoint + CONFIG_OBJ.package_list_method,
+        timeout=CONFIG_OBJ.request_timeout
+    ).json()
     
     # Get as a list
     dataset_list=datasets_response['result']
@@ -0,0 +1,250 @@
+import os
+import csv
+import gzip
+import io
+import json
+import time
+import random
+import string
+import argparse
+import logging
+import threading
+import urllib.parse
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import bsa_utils
+
+class StubFixtures:
+    """
+    Package metadata and per-resource rows served by the CKAN stand-in, either
+    generated from a seed or loaded from recorded fixtures.
+    """
+    def __init__(self, package_id="english-prescribing-dataset-epd-with-snomed-code", months=12,
+                 rows_per_resource=5000, distinct_codes=20000, seed=1):
+        self.package_id = package_id
+        self.resources = {}
+        self.metadata_modified = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")
+        self.columns = ["BNF_CODE", "BNF_DESCRIPTION", "CHEMICAL_SUBSTANCE_BNF_DESCR"]
+        if months:
+            self.generate(months, rows_per_resource, distinct_codes, seed)
+
+    def generate(self, months, rows_per_resource, distinct_codes, seed):
+        rng = random.Random(seed)
+        letters = string.ascii_uppercase
+        codes = []
+        for _ in range(distinct_codes):
+            chem = f"{rng.choice(letters)}{rng.randint(0, 9)}"
+            code = (
+                f"{rng.randint(1, 23):02d}{rng.randint(1, 12):02d}{rng.randint(1, 9):02d}0"
+                f"{chem}{''.join(rng.choice(letters) for _ in range(6))}"
+            )
+            codes.append((code, f"Drug {code[9:]} {rng.randint(1, 500)}mg tablets", f"Substance {chem}"))
+
+        start_year, start_month = 2024, 1
+        for i in range(months):
+            year = start_year + (start_month - 1 + i) // 12
+            month = (start_month - 1 + i) % 12 + 1
+            table_name = f"EPD_SNOMED_{year}{month:02d}"
+            self.resources[table_name] = [rng.choice(codes) for _ in range(rows_per_resource)]
+
+    @classmethod
+    def from_directory(cls, path):
+        """
+        Load recorded fixtures: package_show.json (a package_show response) and
+        one <bq_table_name>.csv file per resource.
+        """
+        fixtures = cls(months=0)
+        with open(os.path.join(path, "package_show.json"), "r") as f:
+            package = json.load(f)["result"]
+        fixtures.package_id = package.get("name", fixtures.package_id)
+        fixtures.metadata_modified = package.get("metadata_modified", fixtures.metadata_modified)
+        for resource in package["resources"]:
+            table_name = resource.get("bq_table_name")
+            csv_path = os.path.join(path, f"{table_name}.csv")
+            if not table_name or not os.path.exists(csv_path):
+                continue
+            with open(csv_path, "r", newline="") as f:
+                reader = csv.reader(f)
+                fixtures.columns = next(reader)
+                fixtures.resources[table_name] = [tuple(row) for row in reader]
+        return fixtures
+
+    def package_show(self):
+        return {
+            "name": self.package_id,
+            "metadata_modified": self.metadata_modified,
+            "resources": [
+                {"id": table_name, "name": table_name, "bq_table_name": table_name,
+                 "last_modified": self.metadata_modified}
+                for table_name in sorted(self.resources)
+            ],
+        }
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Serves the subset of the CKAN action API used by bsa_utils, plus the
+    gzipped CSV shards referenced by truncated datastore_search_sql results.
+    """
+    def log_message(self, format, *args):
+        logging.debug("ckan_stub: " + format % args)
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def inject_fault(self):
+        stub = self.server.stub
+        if stub.latency:
+            time.sleep(stub.latency * stub.rng.uniform(0.5, 1.5))
+        roll = stub.rng.random()
+        if roll < stub.throttle_rate:
+            stub.count("throttled")
+            self.send_response(429)
+            self.send_header("Retry-After", str(stub.retry_after))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return True
+        if roll < stub.throttle_rate + stub.error_rate:
+            stub.count("errors")
+            self.send_json({"success": False, "error": {"message": "Injected server error"}}, status=503)
+            return True
+        return False
+
+    def do_GET(self):
+        stub = self.server.stub
+        parsed = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(parsed.query)
+        action = parsed.path.rstrip("/").split("/")[-1]
+        stub.count(action if not parsed.path.startswith("/gc/") else "gc_download")
+
+        if parsed.path.startswith("/gc/"):
+            return self.send_shard(parsed.path)
+        if action == "package_list":
+            return self.send_json({"success": True, "result": [stub.fixtures.package_id, "foi-01234"]})
+        if action == "package_show":
+            return self.send_json({"success": True, "result": stub.fixtures.package_show()})
+        if action == "package_search":
+            return self.send_json({"success": True, "result": {
+                "count": 1, "results": [{"metadata_modified": stub.fixtures.metadata_modified}]
+            }})
+        if action == "datastore_search_sql":
+            if self.inject_fault():
+                return
+            return self.send_datastore_result(params.get("resource_id", [""])[0])
+        self.send_json({"success": False, "error": {"message": "Not found"}}, status=404)
+
+    def send_datastore_result(self, resource_id):
+        stub = self.server.stub
+        rows = stub.fixtures.resources.get(resource_id)
+        if rows is None:
+            return self.send_json({"success": False, "error": {"message": "Resource not found"}}, status=404)
+        if len(rows) > stub.truncate_at:
+            host = f"http://{self.server.server_address[0]}:{self.server.server_address[1]}"
+            gc_urls = [{"url": f"{host}/gc/{resource_id}/{shard}.csv.gz"} for shard in range(stub.shards)]
+            return self.send_json({"success": True, "result": {"records_truncated": "true", "gc_urls": gc_urls}})
+        records = [dict(zip(stub.fixtures.columns, row)) for row in rows]
+        self.send_json({"success": True, "result": {"result": {"records": records}}})
+
+    def send_shard(self, path):
+        stub = self.server.stub
+        parts = path.strip("/").split("/")
+        rows = stub.fixtures.resources.get(parts[1]) if len(parts) == 3 else None
+        if rows is None:
+            return self.send_json({"success": False}, status=404)
+        shard = int(parts[2].split(".")[0])
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(stub.fixtures.columns)
+        writer.writerows(rows[shard::stub.shards])
+        data = gzip.compress(buffer.getvalue().encode("utf-8"))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/gzip")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class CKANStub:
+    """
+    Local stand-in for the NHSBSA CKAN API with injectable latency, 429s and
+    5xx errors, for exercising ResourceNames, APICall and FetchData offline.
+    """
+    def __init__(self, fixtures=None, host="127.0.0.1", port=0, latency=0.0, throttle_rate=0.0,
+                 error_rate=0.0, retry_after=1, truncate_at=1000, shards=2, seed=1):
+        self.fixtures = fixtures if fixtures else StubFixtures()
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.truncate_at = truncate_at
+        self.shards = max(1, shards)
+        self.rng = random.Random(seed)
+        self.counters = {}
+        self.counters_lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), StubHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.thread = None
+
+    @property
+    def base_endpoint(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/api/3/action/"
+
+    def count(self, name):
+        with self.counters_lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @contextmanager
+    def patched_endpoint(self):
+        """
+        Point bsa_utils at the stand-in for the duration of the block.
+        """
+        original = bsa_utils.CONFIG_OBJ.base_endpoint
+        bsa_utils.CONFIG_OBJ.base_endpoint = self.base_endpoint
+        try:
+            yield self
+        finally:
+            bsa_utils.CONFIG_OBJ.base_endpoint = original
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the NHSBSA CKAN API.")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on.")
+    parser.add_argument("--fixtures", default=None, help="Directory of recorded fixtures (package_show.json and <bq_table_name>.csv).")
+    parser.add_argument("--months", type=int, default=12, help="Number of monthly resources to generate.")
+    parser.add_argument("--rows", type=int, default=5000, help="Rows per generated resource.")
+    parser.add_argument("--truncate-at", type=int, default=1000, help="Serve results above this many rows as gzipped CSV shards.")
+    parser.add_argument("--shards", type=int, default=2, help="Number of gc_urls shards for truncated results.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Mean added latency per datastore request, in seconds.")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of datastore requests answered with 429.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of datastore requests answered with 503.")
+    args = parser.parse_args()
+
+    if args.fixtures:
+        fixtures = StubFixtures.from_directory(args.fixtures)
+    else:
+        fixtures = StubFixtures(months=args.months, rows_per_resource=args.rows)
+
+    stub = CKANStub(fixtures, port=args.port, latency=args.latency, throttle_rate=args.throttle_rate,
+                    error_rate=args.error_rate, truncate_at=args.truncate_at, shards=args.shards)
+    print(f"Serving {len(fixtures.resources)} resources for '{fixtures.package_id}' at {stub.base_endpoint}")
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        stub.server.server_close()
+
+if __name__ == "__main__":
+    main()
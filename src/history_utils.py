@@ -0,0 +1,97 @@
+import os
+import sqlite3
+import logging
+import pandas as pd
+import bsa_utils
+
+class DescriptionHistory:
+    """
+    Append-only SQLite store of every description and chemical substance a
+    BNF code has had, with the first and last month each version was seen.
+    New months only add versions or extend a version's month range, and
+    lookups by code use the index on bnf_code.
+    """
+    columns = ["BNF_CODE", "BNF_DESCRIPTION", "CHEMICAL_SUBSTANCE_BNF_DESCR"]
+
+    def __init__(self, db_path=None):
+        self.db_path = db_path if db_path else os.path.join(bsa_utils.CONFIG_OBJ.DATA_DIR, "description_history.sqlite")
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self.connection = sqlite3.connect(self.db_path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS description_versions (
+                bnf_code TEXT NOT NULL,
+                bnf_description TEXT NOT NULL,
+                chemical_substance TEXT NOT NULL,
+                first_month INTEGER NOT NULL,
+                last_month INTEGER NOT NULL,
+                PRIMARY KEY (bnf_code, bnf_description, chemical_substance)
+            );
+            CREATE INDEX IF NOT EXISTS description_versions_code
+                ON description_versions (bnf_code, last_month);
+        """)
+
+    def close(self):
+        self.connection.close()
+
+    def watermark(self):
+        # The latest month recorded
+        return self.connection.execute("SELECT MAX(last_month) FROM description_versions").fetchone()[0]
+
+    def record_versions(self, df):
+        """
+        Add versions from a frame of the key columns plus first_month and
+        last_month, widening the month range of versions already stored.
+        """
+        if df.empty:
+            return
+        keys = df[self.columns].astype(object).fillna("").astype(str)
+        params = zip(
+            keys["BNF_CODE"], keys["BNF_DESCRIPTION"], keys["CHEMICAL_SUBSTANCE_BNF_DESCR"],
+            df["first_month"].astype(int).tolist(), df["last_month"].astype(int).tolist()
+        )
+        with self.connection:
+            self.connection.executemany("""
+                INSERT INTO description_versions (bnf_code, bnf_description, chemical_substance, first_month, last_month)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (bnf_code, bnf_description, chemical_substance) DO UPDATE SET
+                    first_month = MIN(first_month, excluded.first_month),
+                    last_month = MAX(last_month, excluded.last_month)
+            """, params)
+        logging.info(f"Recorded {len(df)} description versions.")
+
+    def record_month(self, df, month):
+        self.record_versions(df[self.columns].drop_duplicates().assign(first_month=int(month), last_month=int(month)))
+
+    def versions(self, bnf_code):
+        return pd.read_sql_query(
+            "SELECT * FROM description_versions WHERE bnf_code = ? ORDER BY first_month, last_month",
+            self.connection, params=(bnf_code,)
+        )
+
+    def first_seen_descriptions(self, before_month):
+        # Earliest month each description was seen, for months before the given one
+        return pd.read_sql_query("""
+            SELECT bnf_description, MIN(first_month) AS first_month FROM description_versions
+            WHERE first_month < ?
+            GROUP BY bnf_description
+        """, self.connection, params=(int(before_month),))
+
+    def previous_description(self, bnf_code, description, before_month):
+        # Most recent other description of the code seen before the given month.
+        # Versions may run past it on a rerun or backfill, so they are ordered
+        # by their last month before it rather than filtered on last_month.
+        row = self.connection.execute("""
+            SELECT bnf_description FROM description_versions
+            WHERE bnf_code = ? AND first_month < ? AND bnf_description != ?
+            ORDER BY MIN(last_month, ? - 1) DESC
+            LIMIT 1
+        """, (str(bnf_code), int(before_month), str(description), int(before_month))).fetchone()
+        return row[0] if row else None
+
+    def add_previous_descriptions(self, df, month):
+        df = df.copy()
+        df["PREVIOUS_DESCRIPTION"] = [
+            self.previous_description(code, description, month)
+            for code, description in zip(df["BNF_CODE"].astype(object), df["BNF_DESCRIPTION"].astype(object))
+        ]
+        return df
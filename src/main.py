@@ -3,6 +3,9 @@ import bsa_utils
 import utils
 import testing_utils
 import op_utils
+import match_utils
+import history_utils
+import template_utils
 import os
 from datetime import datetime
 import argparse
@@ -19,24 +22,10 @@ def validate_yyyymm(value):
         )
 
 def check_latest_published_report():
-    def sort_files_by_date_desc(html_files):
-        return sorted(
-            html_files,
-            key=lambda filename: filename.split('_')[-1].split('.')[0] if '-' in filename else '',
-            reverse=True
-        )
-
-    def extract_date(filename):
-            # Extract the date portion (YYYY-MM) from the filename
-            return filename.split('_')[-1].split('.')[0] if '-' in filename else None
-
-    reports_dir = os.path.join(os.getcwd(), "reports")
-    report_html_files = [f for f in os.listdir(reports_dir) if f.endswith('.html') and f.startswith('monthly_report')]
-    test_report_html_files = [f for f in os.listdir(reports_dir) if f.endswith('.html') and f.startswith('monthly_test_report')]
-    sorted_report_html_files = sort_files_by_date_desc(report_html_files)
-    sorted_test_report_html_files = sort_files_by_date_desc(test_report_html_files)
-    if extract_date(sorted_report_html_files[0]) == extract_date(sorted_test_report_html_files[0]):
-        return extract_date(sorted_report_html_files[0])
+    manifest = template_utils.report_manifest(os.path.join(os.getcwd(), "reports"))
+    latest_report = manifest.latest("monthly_report")
+    if latest_report == manifest.latest("monthly_test_report"):
+        return latest_report
     else:
         return False
 
@@ -64,22 +53,75 @@ def check_if_up_to_date(dataset_id):
         logging.info(f"New data is available.")
         return False
     
-def compare_data(selected_dataset, existing_data_extract, latest_data_extract, data_for, exclude_chapters=[]):
+def load_description_index(month, existing_data_extract=None, description_history=None):
+    """
+    Load the description index and seed it with what was known before month
+    (YYYYMM): the historic extract if there is one, otherwise the first-seen
+    months in the description history.
+    """
+    # Matching descriptions is an aid for reviewers, so never let it stop a report
+    try:
+        description_index = match_utils.DescriptionIndex()
+        if existing_data_extract is not None:
+            description_index.update(existing_data_extract['BNF_DESCRIPTION'], op_utils.previous_year_month(month))
+        elif description_history is not None:
+            first_seen = description_history.first_seen_descriptions(month)
+            description_index.update(first_seen['bnf_description'], first_seen['first_month'].to_numpy())
+        else:
+            logging.warning(f"Description index not seeded with history before {month}; matches rely on descriptions already indexed.")
+        description_index.save()
+        return description_index
+    except Exception as e:
+        logging.warning(f"Description matching unavailable: {e}")
+        return None
+
+def load_description_history(month):
+    # Bring the history up to the month before this one; like description
+    # matching, this is an aid for reviewers and never stops a report
+    try:
+        description_history = history_utils.DescriptionHistory()
+        watermark = description_history.watermark()
+        if watermark is None or watermark < op_utils.previous_year_month(month):
+            logging.info(f"Updating description history after {watermark} and before {month}.")
+            description_history.record_versions(op_utils.retrieve_description_versions(month, watermark))
+        return description_history
+    except Exception as e:
+        logging.warning(f"Description history unavailable: {e}")
+        return None
+
+def compare_data(selected_dataset, existing_data_extract, latest_data_extract, data_for, exclude_chapters=[], new_values=None):
     if selected_dataset == 'epd':
         logging.info(f"Comparing data for EPD dataset.")
         try:
+            month = int(data_for.replace('-', ''))
+            description_history = load_description_history(month)
+            description_index = load_description_index(month, existing_data_extract, description_history)
             compare_data = utils.CompareLatest(
                 existing_data_extract,
                 latest_data_extract,
-                exclude_chapters=[]
+                exclude_chapters=[],
+                new_values=new_values,
+                description_index=description_index,
+                report_month=month
             )
 
             chem_subs = compare_data.return_new_chem_subs()
             bnf_codes = compare_data.return_new_bnf_codes()
             return_new_desc_only = compare_data.return_new_desc_only()
+            if description_history is not None:
+                return_new_desc_only = description_history.add_previous_descriptions(return_new_desc_only, month)
             utils.write_monthly_report_html(chem_subs, bnf_codes, return_new_desc_only, data_for)
             utils.generate_list_reports_html()
             testing_utils.run_tests(bnf_codes, data_for)
+
+            if description_history is not None:
+                description_history.record_month(latest_data_extract, month)
+                description_history.close()
+
+            # Later months match against this month's descriptions too
+            if description_index is not None:
+                description_index.update(latest_data_extract['BNF_DESCRIPTION'], month)
+                description_index.save()
         except Exception as e:
             print(f"Error comparing data: {e}")
             return
@@ -88,12 +130,14 @@ def compare_data(selected_dataset, existing_data_extract, latest_data_extract, d
         try:
             compare = utils.CompareLatestSCMD(
                 existing_data_extract,
-                latest_data_extract
+                latest_data_extract,
+                new_values=new_values
             )
 
             new_vtms = compare.return_new_vtms()
             new_vmps = compare.return_new_vmps()
-            utils.write_monthly_report_html_scmd(new_vtms, new_vmps, data_for)
+            invalid_vmps = compare.return_invalid_vmps()
+            utils.write_monthly_report_html_scmd(new_vtms, new_vmps, data_for, invalid_vmps=invalid_vmps)
             utils.generate_list_reports_html_scmd()
             #testing_utils.run_tests(new_vmps, data_for)
         except Exception as e:
@@ -105,17 +149,7 @@ def convert_to_yyyymm(date):
     yyyymm_str = ts.strftime('%Y%m')
     return yyyymm_str
 
-def update_reports(dataset_id, selected_dataset, month=None):
-    logging.info(f"Updating reports.")
-    if month:
-        latest_published_yyyymm = month
-        logging.info(f"Using specified month {latest_published_yyyymm}")
-    else:
-        latest_published_data = check_latest_published_data(dataset_id)
-        latest_published_yyyymm = convert_to_yyyymm(latest_published_data)
-        logging.info(f"Latest published data {latest_published_yyyymm}")
-
-    # FIND NEW PRODUCTS
+def dataset_sql(selected_dataset):
     #sql = (
     #    "SELECT DISTINCT BNF_CODE, BNF_DESCRIPTION, CHEMICAL_SUBSTANCE_BNF_DESCR "
     #    "{FROM_TABLE}"
@@ -134,7 +168,24 @@ def update_reports(dataset_id, selected_dataset, month=None):
             "VMP_SNOMED_CODE AS vmp_snomed_code, "
             "VMP_PRODUCT_NAME AS vmp_product_name "
             "{FROM_TABLE} "
-        )        
+        )
+    return sql
+
+def update_reports(dataset_id, selected_dataset, month=None, workers=None, string_dtype="object", pushdown=False):
+    logging.info(f"Updating reports.")
+    if month:
+        latest_published_yyyymm = month
+        logging.info(f"Using specified month {latest_published_yyyymm}")
+    else:
+        latest_published_data = check_latest_published_data(dataset_id)
+        latest_published_yyyymm = convert_to_yyyymm(latest_published_data)
+        logging.info(f"Latest published data {latest_published_yyyymm}")
+
+    # FIND NEW PRODUCTS
+    sql = dataset_sql(selected_dataset)
+
+    # Pushing the comparison down to BigQuery is only supported for EPD
+    pushdown = pushdown and selected_dataset == 'epd'
 
     try:
         # Fetch existing data using BSA API
@@ -142,11 +193,15 @@ def update_reports(dataset_id, selected_dataset, month=None):
         #date_to = "latest-1"  # Can be "YYYYMM" or "latest" or "latest-1", default="latest"
 
         #existing_data_extract = bsa_utils.FetchData(resource=dataset_id, date_from=date_from, date_to=date_to, sql=sql, cache=True)
-        if selected_dataset == 'epd':
-            existing_data_extract = op_utils.retrieve_historic_drugs(latest_published_yyyymm)
+        if pushdown:
+            # New items are found in BigQuery once the latest extract is available
+            existing_data_extract = None
+        elif selected_dataset == 'epd':
+            existing_data_extract = op_utils.retrieve_historic_drugs(latest_published_yyyymm, string_dtype=string_dtype)
         elif selected_dataset == 'scmd':
-            existing_data_extract = op_utils.retrieve_historic_drugs_scmd(latest_published_yyyymm)
-        logging.info(f"Fetched {len(existing_data_extract)} existing records.")
+            existing_data_extract = op_utils.retrieve_historic_drugs_scmd(latest_published_yyyymm, string_dtype=string_dtype)
+        if existing_data_extract is not None:
+            logging.info(f"Fetched {len(existing_data_extract)} existing records.")
 
         # Extract latest data from EPD
         if month:
@@ -156,19 +211,27 @@ def update_reports(dataset_id, selected_dataset, month=None):
             date_from = "latest"  # Can be "YYYYMM" or "earliest" or "latest", default="earliest"
             date_to = "latest"  # Can be "YYYYMM" or "latest" or "latest-1", default="latest"
 
-        # Fetch latest data using BSA API
-        latest_data_extract = bsa_utils.FetchData(resource=dataset_id, date_from=date_from, date_to=date_to, sql=sql)
+        # Fetch latest data using BSA API. Completed resources are kept in the
+        # result cache, so rerunning after an interruption skips them
+        latest_data_extract = bsa_utils.FetchData(resource=dataset_id, date_from=date_from, date_to=date_to, sql=sql, max_workers=workers, cache=True, string_dtype=string_dtype)
         logging.info(f"Fetched {latest_data_extract.count_results()} new records.")
 
+        # A partial extract would under-report new items, so stop rather than compare it
+        failed_resources = latest_data_extract.return_failed_resources()
+        if failed_resources:
+            logging.error(f"Failed to fetch resources: {', '.join(failed_resources)}. Exiting...")
+            return
+
     except Exception as e:
         print(f"Error fetching existing data: {e}")
         return
 
     # Validate fetched data
-    if len(existing_data_extract) == 0 and latest_data_extract.count_results() == 0:
+    existing_failed = existing_data_extract is not None and len(existing_data_extract) == 0
+    if existing_failed and latest_data_extract.count_results() == 0:
         logging.error("Both existing and new data fetches failed. Exiting...")
         return
-    elif len(existing_data_extract) == 0:
+    elif existing_failed:
         logging.error("Failed to fetch existing data. Exiting...")
         return
     elif latest_data_extract.count_results() == 0:
@@ -180,11 +243,71 @@ def update_reports(dataset_id, selected_dataset, month=None):
     data_for = latest_data_extract.return_resources_to()
     latest_data_extract = latest_data_extract.results()
 
+    new_values = None
+    if pushdown:
+        try:
+            new_values = op_utils.retrieve_new_epd_values(latest_data_extract, latest_published_yyyymm)
+        except Exception as e:
+            print(f"Error finding new items in BigQuery: {e}")
+            return
+
     if selected_dataset == 'scmd':
-        existing_data_extract, latest_data_extract = op_utils.join_vtms(existing_data_extract, latest_data_extract)
+        existing_data_extract, latest_data_extract = op_utils.join_vtms(existing_data_extract, latest_data_extract, string_dtype=string_dtype)
     
-    compare_data(selected_dataset, existing_data_extract, latest_data_extract, data_for, exclude_chapters=[])
+    compare_data(selected_dataset, existing_data_extract, latest_data_extract, data_for, exclude_chapters=[], new_values=new_values)
+
+
+def backfill_reports(dataset_id, selected_dataset, month_from, month_to, workers=None, string_dtype="object"):
+    """
+    Regenerate the reports for every month from month_from to month_to. History
+    before month_from is loaded once; each month is then compared against the
+    values seen so far, and its new values are added to them.
+    """
+    months = [period.strftime('%Y%m') for period in pd.period_range(
+        pd.Period(month_from, freq='M'), pd.Period(month_to, freq='M'), freq='M'
+    )]
+    logging.info(f"Backfilling reports for {len(months)} months from {months[0]} to {months[-1]}.")
+    sql = dataset_sql(selected_dataset)
+
+    try:
+        if selected_dataset == 'epd':
+            existing_data_extract = op_utils.retrieve_historic_drugs(month_from, string_dtype=string_dtype)
+            seen_keys = utils.SeenKeys(existing_data_extract, utils.CompareLatest.KEY_COLUMNS)
+            load_description_index(int(month_from), existing_data_extract)
+        elif selected_dataset == 'scmd':
+            existing_data_extract = op_utils.retrieve_historic_drugs_scmd(month_from, string_dtype=string_dtype)
+            _, existing_data_extract = op_utils.join_vtms(None, existing_data_extract, string_dtype=string_dtype)
+            seen_keys = utils.SeenKeys(existing_data_extract, utils.CompareLatestSCMD.KEY_COLUMNS)
+    except Exception as e:
+        print(f"Error fetching existing data: {e}")
+        return
+    logging.info(f"Fetched {len(existing_data_extract)} existing records.")
+    if len(existing_data_extract) == 0:
+        logging.error("Failed to fetch existing data. Exiting...")
+        return
+    del existing_data_extract
+
+    for month in months:
+        logging.info(f"Backfilling {month}.")
+        latest_data_extract = bsa_utils.FetchData(resource=dataset_id, date_from=month, date_to=month, sql=sql, max_workers=workers, cache=True, string_dtype=string_dtype)
+
+        # Later months are compared against this one, so stop at the first gap
+        failed_resources = latest_data_extract.return_failed_resources()
+        if failed_resources:
+            logging.error(f"Failed to fetch resources: {', '.join(failed_resources)}. Exiting...")
+            return
+        if latest_data_extract.count_results() == 0:
+            logging.error(f"Failed to fetch new data for {month}. Exiting...")
+            return
+
+        data_for = latest_data_extract.return_resources_to()
+        latest_data_extract = latest_data_extract.results()
+        if selected_dataset == 'scmd':
+            _, latest_data_extract = op_utils.join_vtms(None, latest_data_extract, string_dtype=string_dtype)
 
+        new_values = seen_keys.new_values(latest_data_extract)
+        compare_data(selected_dataset, None, latest_data_extract, data_for, exclude_chapters=[], new_values=new_values)
+        seen_keys.add(new_values)
 
 def main():
     # Create the parser
@@ -213,12 +336,57 @@ def main():
         help="Specify the month in YYYYMM format."
     )
     
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of concurrent API requests when fetching data (default from bsa_utils config)."
+    )
+
+    parser.add_argument(
+        "--string-dtype",
+        choices=bsa_utils.STRING_DTYPES,
+        default="object",
+        help="Storage for string columns: 'object' (default), 'pyarrow' (Arrow-backed strings) or 'category' (dictionary encoded)."
+    )
+
+    parser.add_argument(
+        "--pushdown",
+        action="store_true",
+        help="EPD only: find new items in BigQuery instead of downloading the full history."
+    )
+
+    parser.add_argument(
+        "--from",
+        dest="month_from",
+        type=validate_yyyymm,
+        default=None,
+        help="Backfill reports from this month (YYYYMM), loading history only once. Requires --to."
+    )
+
+    parser.add_argument(
+        "--to",
+        dest="month_to",
+        type=validate_yyyymm,
+        default=None,
+        help="Last month (YYYYMM) to backfill. Requires --from."
+    )
+
     # Parse the command-line arguments
     args = parser.parse_args()
+    if (args.month_from is None) != (args.month_to is None):
+        parser.error("--from and --to must be used together.")
+    if args.month_from and args.month:
+        parser.error("--month cannot be combined with --from/--to.")
+    if args.month_from and args.month_from > args.month_to:
+        parser.error("--from must not be after --to.")
     
     # Access the mode argument
     mode = args.mode
     month = args.month
+    workers = args.workers
+    string_dtype = args.string_dtype
+    pushdown = args.pushdown
     selected_dataset = args.dataset
 
     if selected_dataset == 'epd':
@@ -226,13 +394,19 @@ def main():
     elif selected_dataset == 'scmd':
         dataset_id = "secondary-care-medicines-data-indicative-price"  # Dataset ID
 
-    if mode == "force":
-        update_reports(dataset_id, selected_dataset, month=month)
-    elif mode == "auto":
-        if check_if_up_to_date(dataset_id):
-            print("The reports are up to date.")
-        else:
-            update_reports(dataset_id, selected_dataset)
+    try:
+        if args.month_from:
+            backfill_reports(dataset_id, selected_dataset, args.month_from, args.month_to, workers=workers, string_dtype=string_dtype)
+        elif mode == "force":
+            update_reports(dataset_id, selected_dataset, month=month, workers=workers, string_dtype=string_dtype, pushdown=pushdown)
+        elif mode == "auto":
+            if check_if_up_to_date(dataset_id):
+                print("The reports are up to date.")
+            else:
+                update_reports(dataset_id, selected_dataset, workers=workers, string_dtype=string_dtype, pushdown=pushdown)
+    finally:
+        # Report BigQuery usage for this run, including runs that failed part way
+        op_utils.write_query_report()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,185 @@
+import os
+import re
+import logging
+import numpy as np
+import pandas as pd
+import bsa_utils
+
+# Mersenne prime modulus for the MinHash permutations
+_PRIME = np.uint64((1 << 61) - 1)
+_whitespace_re = re.compile(r'\s+')
+
+def normalise_description(description):
+    # Case and spacing changes alone should not count as a different description
+    text = _whitespace_re.sub(' ', str(description).lower()).strip()
+    return f" {text} "
+
+def shingle_set(description, size=3):
+    text = normalise_description(description)
+    return {text[i:i + size] for i in range(max(1, len(text) - size + 1))}
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+class DescriptionIndex:
+    """
+    MinHash LSH index over BNF descriptions for finding the closest existing
+    descriptions to a new one. Descriptions are shingled into character
+    3-grams, and each band of their MinHash signature is kept as a sorted
+    array of keys, so candidates are found with binary searches and then
+    ranked by exact Jaccard similarity. The signatures are persisted in the
+    data directory so only descriptions not already indexed are hashed.
+    Each description keeps the earliest month it is known to have been seen,
+    so a report only matches descriptions that existed before its month.
+    """
+    def __init__(self, index_dir=None, num_perm=64, bands=16, shingle_size=3, seed=1):
+        index_dir = index_dir if index_dir else os.path.join(bsa_utils.CONFIG_OBJ.DATA_DIR, "description_index")
+        self.store = bsa_utils.ParquetStore(index_dir, "description_index")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows_per_band = num_perm // bands
+        self.shingle_size = shingle_size
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        # Shingle ids fit in 24 bits, so a * id + b stays below 2**64
+        self.perm_a = rng.integers(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self.perm_b = rng.integers(0, 1 << 32, size=num_perm, dtype=np.uint64)
+        self.descriptions = pd.Index([], dtype=object)
+        self.signatures = np.empty((0, num_perm), dtype=np.uint64)
+        self.first_months = np.empty(0, dtype=np.int64)
+        self.changed = False
+        self.band_keys = None
+        self.band_order = None
+        self.load()
+
+    def settings(self):
+        return {"num_perm": self.num_perm, "bands": self.bands, "shingle_size": self.shingle_size, "seed": self.seed}
+
+    def load(self):
+        table, meta = self.store.load()
+        if table is None:
+            return
+        if meta.get("settings") != self.settings() or "first_month" not in table.columns:
+            logging.info("Description index settings have changed, rebuilding.")
+            return
+        self.descriptions = pd.Index(table["description"].astype(object))
+        self.first_months = np.array(table["first_month"], dtype=np.int64)
+        self.signatures = table.drop(columns=["description", "first_month"]).to_numpy(dtype=np.uint64)
+
+    def save(self):
+        if not self.changed:
+            return
+        table = pd.DataFrame(self.signatures, columns=[f"h{i}" for i in range(self.num_perm)])
+        table.insert(0, "description", np.asarray(self.descriptions, dtype=object))
+        table.insert(1, "first_month", self.first_months)
+        if self.store.save(table, {"settings": self.settings(), "rows": len(table)}):
+            self.changed = False
+
+    def shingle_ids(self, descriptions):
+        """
+        Integer ids of every character shingle of every description, as one flat
+        array, plus the offset of each description's first shingle.
+        """
+        encoded = [normalise_description(d).encode("utf-8") for d in descriptions]
+        lengths = np.fromiter((len(e) for e in encoded), dtype=np.int64, count=len(encoded))
+        buffer = np.frombuffer(b"".join(encoded), dtype=np.uint8).astype(np.uint64)
+        counts = np.maximum(lengths - self.shingle_size + 1, 1)
+        text_starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+        # Position in buffer of each shingle's first byte
+        positions = np.repeat(text_starts - offsets, counts) + np.arange(counts.sum())
+        ids = np.zeros(len(positions), dtype=np.uint64)
+        padded = np.concatenate([buffer, np.zeros(self.shingle_size, dtype=np.uint64)])
+        for i in range(self.shingle_size):
+            ids = (ids << np.uint64(8)) | padded[positions + i]
+        return ids, offsets
+
+    def compute_signatures(self, descriptions, chunk_size=20000):
+        signatures = np.empty((len(descriptions), self.num_perm), dtype=np.uint64)
+        for start in range(0, len(descriptions), chunk_size):
+            ids, offsets = self.shingle_ids(descriptions[start:start + chunk_size])
+            for j in range(self.num_perm):
+                hashed = (self.perm_a[j] * ids + self.perm_b[j]) % _PRIME
+                signatures[start:start + len(offsets), j] = np.minimum.reduceat(hashed, offsets)
+        return signatures
+
+    def compute_band_keys(self, signatures):
+        # One 64-bit key per band; collisions only add candidates, which are checked exactly
+        keys = np.zeros((len(signatures), self.bands), dtype=np.uint64)
+        multiplier = np.uint64(0x9E3779B97F4A7C15)
+        for band in range(self.bands):
+            rows = signatures[:, band * self.rows_per_band:(band + 1) * self.rows_per_band]
+            for column in range(rows.shape[1]):
+                keys[:, band] = (keys[:, band] ^ rows[:, column]) * multiplier
+        return keys
+
+    def update(self, descriptions, months):
+        """
+        Record descriptions seen in the given month (YYYYMM), either one month
+        for all of them or one per description. Descriptions already indexed
+        keep the earliest month either source gives them; the rest are added.
+        """
+        seen = pd.DataFrame({"description": pd.Series(descriptions, dtype=object).to_numpy(), "month": months})
+        seen = seen.dropna().groupby("description", sort=False)["month"].min().astype(np.int64)
+
+        positions = self.descriptions.get_indexer(seen.index)
+        known = positions >= 0
+        earlier = seen.to_numpy()[known] < self.first_months[positions[known]]
+        if earlier.any():
+            self.first_months[positions[known][earlier]] = seen.to_numpy()[known][earlier]
+            self.changed = True
+
+        missing = seen[~known]
+        if len(missing) == 0:
+            return
+        logging.info(f"Adding {len(missing)} descriptions to the description index.")
+        self.signatures = np.vstack([self.signatures, self.compute_signatures(list(missing.index))])
+        self.descriptions = self.descriptions.append(pd.Index(missing.index, dtype=object))
+        self.first_months = np.concatenate([self.first_months, missing.to_numpy()])
+        self.band_keys = None
+        self.changed = True
+
+    def build_bands(self):
+        keys = self.compute_band_keys(self.signatures)
+        self.band_order = np.argsort(keys, axis=0, kind="stable")
+        self.band_keys = np.take_along_axis(keys, self.band_order, axis=0)
+
+    def candidates(self, signature):
+        if self.band_keys is None:
+            self.build_bands()
+        query_keys = self.compute_band_keys(signature[np.newaxis, :])[0]
+        found = []
+        for band in range(self.bands):
+            column = self.band_keys[:, band]
+            low = np.searchsorted(column, query_keys[band], side="left")
+            high = np.searchsorted(column, query_keys[band], side="right")
+            found.append(self.band_order[low:high, band])
+        return np.unique(np.concatenate(found)) if found else np.array([], dtype=np.int64)
+
+    def closest(self, descriptions, limit=3, min_similarity=0.5, before_month=None):
+        """
+        For each description, the most similar indexed descriptions (other than
+        itself) as a list of (description, similarity), best first. With
+        before_month (YYYYMM), only descriptions first seen before it count.
+        """
+        descriptions = list(descriptions)
+        if not descriptions or len(self.descriptions) == 0:
+            return [[] for _ in descriptions]
+        signatures = self.compute_signatures(descriptions)
+        results = []
+        for description, signature in zip(descriptions, signatures):
+            query = shingle_set(description, self.shingle_size)
+            matches = []
+            for position in self.candidates(signature):
+                candidate = self.descriptions[position]
+                if candidate == description:
+                    continue
+                if before_month is not None and self.first_months[position] >= before_month:
+                    continue
+                similarity = jaccard(query, shingle_set(candidate, self.shingle_size))
+                if similarity >= min_similarity:
+                    matches.append((candidate, similarity))
+            matches.sort(key=lambda match: -match[1])
+            results.append(matches[:limit])
+        return results
@@ -1,10 +1,21 @@
 from google.cloud import bigquery
 from google.oauth2 import service_account
+from google.api_core import exceptions as google_exceptions
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import re
 import os
 import json
 import logging
+from datetime import datetime, timedelta
+import bsa_utils
+
+try:
+    from google.cloud import bigquery_storage
+except ImportError:  # Streaming falls back to the REST API without it
+    bigquery_storage = None
 
 def make_bq_client():
     env_json = os.getenv("BQ_SERVICE_ACCOUNT_KEY")
@@ -19,10 +30,193 @@ def make_bq_client():
     if os.path.exists(key_path):
         return bigquery.Client.from_service_account_json(key_path)
 
-def retrieve_historic_drugs(before_year_month: str | int) -> pd.DataFrame:
+_bq_client = None
+_bqstorage_client = None
+QUERY_STATS = []
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+def get_bq_client():
+    """
+    Return the BigQuery client shared by every query in this run.
+    """
+    global _bq_client
+    if _bq_client is None:
+        _bq_client = make_bq_client()
+    return _bq_client
+
+def get_bqstorage_client(client):
+    global _bqstorage_client
+    if _bqstorage_client is None and bigquery_storage is not None:
+        try:
+            _bqstorage_client = bigquery_storage.BigQueryReadClient(credentials=client._credentials)
+        except Exception as e:
+            logging.warning(f"Could not create BigQuery Storage client, using REST API: {e}")
+    return _bqstorage_client
+
+def max_bytes_per_query():
+    value = os.getenv("BQ_MAX_BYTES_PER_QUERY")
+    return int(value) if value else None
+
+def run_query(sql, job_config, label):
+    """
+    Run a query on the shared client. A dry run first estimates the bytes it
+    will process, which must be within BQ_MAX_BYTES_PER_QUERY when that is
+    set; the job's statistics are then recorded in QUERY_STATS.
+    """
+    client = get_bq_client()
+    budget = max_bytes_per_query()
+
+    dry_run_config = bigquery.QueryJobConfig.from_api_repr(job_config.to_api_repr())
+    dry_run_config.dry_run = True
+    dry_run_config.use_query_cache = False
+    estimated_bytes = client.query(sql, job_config=dry_run_config).total_bytes_processed or 0
+    logging.info(f"Query '{label}' will process an estimated {estimated_bytes / 1e9:.2f} GB.")
+    if budget is not None and estimated_bytes > budget:
+        raise QueryBudgetExceeded(
+            f"Query '{label}' would process {estimated_bytes} bytes, over the budget of {budget} bytes."
+        )
+    if budget is not None:
+        # Also have BigQuery enforce the budget in case the estimate was low
+        job_config.maximum_bytes_billed = budget
+
+    job = client.query(sql, job_config=job_config)
+    rows = job.result()
+    QUERY_STATS.append({
+        "label": label,
+        "job_id": job.job_id,
+        "estimated_bytes": estimated_bytes,
+        "bytes_processed": job.total_bytes_processed,
+        "bytes_billed": job.total_bytes_billed,
+        "cache_hit": job.cache_hit,
+        "slot_millis": job.slot_millis,
+        "elapsed_seconds": (job.ended - job.started).total_seconds() if job.started and job.ended else None,
+        "rows": rows.total_rows,
+    })
+    return rows
+
+def write_query_report(report_dir=None):
+    """
+    Log this run's query statistics, compared with the previous run's, and
+    save them as JSON under the data directory.
+    """
+    if not QUERY_STATS:
+        return None
+    report_dir = report_dir if report_dir else os.path.join(bsa_utils.CONFIG_OBJ.DATA_DIR, "bq_reports")
+    os.makedirs(report_dir, exist_ok=True)
+
+    previous = {}
+    previous_reports = sorted(f for f in os.listdir(report_dir) if f.endswith(".json"))
+    if previous_reports:
+        try:
+            with open(os.path.join(report_dir, previous_reports[-1]), "r") as f:
+                previous = {entry["label"]: entry for entry in json.load(f)["queries"]}
+        except (OSError, ValueError, KeyError):
+            previous = {}
+
+    for entry in QUERY_STATS:
+        message = (
+            f"BigQuery '{entry['label']}': {(entry['bytes_billed'] or 0) / 1e9:.2f} GB billed, "
+            f"cache hit {entry['cache_hit']}, {entry['elapsed_seconds']}s elapsed, {entry['rows']} rows"
+        )
+        previous_billed = previous.get(entry["label"], {}).get("bytes_billed")
+        if previous_billed:
+            message += f" ({(entry['bytes_billed'] or 0) / previous_billed:.0%} of previous run)"
+        logging.info(message)
+
+    total_billed = sum(entry["bytes_billed"] or 0 for entry in QUERY_STATS)
+    logging.info(f"BigQuery total for this run: {total_billed / 1e9:.2f} GB billed over {len(QUERY_STATS)} queries.")
+
+    report_path = os.path.join(report_dir, f"bq_stats_{datetime.now().strftime('%Y%m%dT%H%M%S')}.json")
+    with open(report_path, "w") as f:
+        json.dump({"total_bytes_billed": total_billed, "queries": QUERY_STATS}, f, indent=2)
+    return report_path
+
+def query_to_dataframe(sql, job_config, string_dtype="object", label="query"):
+    """
+    Run a query and return the result as a DataFrame, downloaded through the
+    shared BigQuery Storage Read API client when available. If the Storage API
+    fails, the result is read through the REST API instead. String columns
+    are loaded directly as the requested string dtype where to_dataframe
+    supports it.
+    """
+    rows = run_query(sql, job_config, label)
+    pandas_string = bsa_utils.pandas_string_dtype(string_dtype)
+    bqstorage_client = get_bqstorage_client(get_bq_client())
+    if bqstorage_client is not None:
+        try:
+            df = rows.to_dataframe(bqstorage_client=bqstorage_client, string_dtype=pandas_string)
+            return bsa_utils.convert_string_columns(df, string_dtype)
+        except google_exceptions.GoogleAPICallError as e:
+            logging.warning(f"BigQuery Storage Read API unavailable, using REST API: {e}")
+    df = rows.to_dataframe(create_bqstorage_client=False, string_dtype=pandas_string)
+    return bsa_utils.convert_string_columns(df, string_dtype)
+
+def query_batches(sql, job_config, label="query"):
+    """
+    Run a query and yield its result as Arrow record batches as they arrive,
+    streamed through the shared BigQuery Storage Read API client when
+    available, so callers can reduce each batch before the next is read. If
+    the Storage API fails before the first batch, the result is paged through
+    the REST API instead.
+    """
+    rows = run_query(sql, job_config, label)
+    bqstorage_client = get_bqstorage_client(get_bq_client())
+    if bqstorage_client is not None:
+        streamed = False
+        try:
+            for batch in rows.to_arrow_iterable(bqstorage_client=bqstorage_client):
+                streamed = True
+                yield batch
+            return
+        except google_exceptions.GoogleAPICallError as e:
+            if streamed:
+                raise
+            logging.warning(f"BigQuery Storage Read API unavailable, using REST API: {e}")
+    yield from rows.to_arrow_iterable()
+
+def batch_to_dataframe(batch, string_dtype="object"):
+    # Integers stay exact as Int64, as to_dataframe loads them
+    pandas_string = bsa_utils.pandas_string_dtype(string_dtype)
+    types = {pa.int64(): pd.Int64Dtype()}
+    if pandas_string is not None:
+        types.update({pa.string(): pandas_string, pa.large_string(): pandas_string})
+    return batch.to_pandas(types_mapper=types.get)
+
+class HistoricSnapshot:
+    """
+    Local parquet snapshot of distinct historic rows plus a YEAR_MONTH
+    watermark (the latest month the snapshot covers), so later runs only
+    need to query the months after it.
+    """
+    def __init__(self, name, snapshot_dir=None):
+        self.snapshot_dir = snapshot_dir if snapshot_dir else os.path.join(bsa_utils.CONFIG_OBJ.DATA_DIR, "historic_snapshots")
+        self.store = bsa_utils.ParquetStore(self.snapshot_dir, name)
+
+    def load(self):
+        # Snapshots written before they were stored as plain strings may hold categoricals
+        df, meta = self.store.load()
+        try:
+            return (bsa_utils.plain_string_columns(df), int(meta["watermark"])) if df is not None else (None, None)
+        except (KeyError, TypeError, ValueError) as e:
+            logging.warning(f"Ignoring snapshot {self.store.data_path} without a watermark: {e}")
+            return None, None
+
+    def save(self, df, watermark):
+        # Stored as plain strings whatever --string-dtype the run used; callers convert on load
+        return self.store.save(bsa_utils.plain_string_columns(df), {"watermark": int(watermark), "rows": len(df)})
+
+def previous_year_month(year_month: int) -> int:
+    year, month = divmod(year_month, 100)
+    return (year - 1) * 100 + 12 if month == 1 else year_month - 1
+
+def retrieve_historic_drugs(before_year_month: str | int, string_dtype: str = "object", use_snapshot: bool = True) -> pd.DataFrame:
     """
     Return distinct drug rows from BigQuery where YEAR_MONTH < before_year_month.
     Reads credentials from bq-service-account.json and returns a pandas DataFrame.
+    string_dtype selects "object", "pyarrow" or "category" string columns.
+    With use_snapshot, only months after the local snapshot's watermark are queried.
     """
 
     # Normalise and validate the cutoff like 'YYYYMM'
@@ -31,29 +225,173 @@ def retrieve_historic_drugs(before_year_month: str | int) -> pd.DataFrame:
         raise ValueError("before_year_month must be a 6-digit string or int like 202506")
     cutoff = int(s)
 
-    client = make_bq_client()
+    columns = ["BNF_CHEMICAL_SUBSTANCE", "CHEMICAL_SUBSTANCE_BNF_DESCR", "BNF_CODE", "BNF_DESCRIPTION"]
+    snapshot = HistoricSnapshot("epd_historic_drugs")
+    snapshot_df, watermark = snapshot.load() if use_snapshot else (None, None)
+    if snapshot_df is not None and watermark >= cutoff:
+        # The snapshot already includes months at or after the cutoff (e.g. re-running an older month)
+        logging.info(f"Snapshot watermark {watermark} is not before {cutoff}, querying full history.")
+        snapshot_df, watermark = None, None
+        update_snapshot = False
+    else:
+        update_snapshot = use_snapshot
+
+    if snapshot_df is not None and watermark >= previous_year_month(cutoff):
+        logging.info(f"Snapshot is up to date to {watermark}, no historic query needed.")
+        return bsa_utils.convert_string_columns(snapshot_df, string_dtype)
 
     sql = """
-        SELECT DISTINCT
+        SELECT
             BNF_CHEMICAL_SUBSTANCE,
             CHEMICAL_SUBSTANCE_BNF_DESCR,
             BNF_CODE,
-            BNF_DESCRIPTION
-        FROM `ebmdatalab.hscic.raw_prescribing_v2`
-        WHERE SAFE_CAST(REGEXP_REPLACE(YEAR_MONTH, r'[^0-9]', '') AS INT64) < @cutoff
+            BNF_DESCRIPTION,
+            MAX(year_month) AS last_year_month
+        FROM (
+            SELECT
+                *,
+                SAFE_CAST(REGEXP_REPLACE(YEAR_MONTH, r'[^0-9]', '') AS INT64) AS year_month
+            FROM `ebmdatalab.hscic.raw_prescribing_v2`
+        )
+        WHERE year_month < @cutoff
+          AND year_month > @watermark
+        GROUP BY 1, 2, 3, 4
     """
 
     job_config = bigquery.QueryJobConfig(
-        query_parameters=[bigquery.ScalarQueryParameter("cutoff", "INT64", cutoff)]
+        query_parameters=[
+            bigquery.ScalarQueryParameter("cutoff", "INT64", cutoff),
+            bigquery.ScalarQueryParameter("watermark", "INT64", watermark if watermark is not None else 0),
+        ]
     )
 
-    df = client.query(sql, job_config=job_config).to_dataframe()
+    if watermark is not None:
+        logging.info(f"Querying historic drugs after snapshot watermark {watermark}.")
+
+    # Batches are merged into the snapshot's rows as they arrive, keeping only
+    # the watermark of the month column rather than the column itself
+    accumulator = bsa_utils.DistinctAccumulator()
+    accumulator.add(snapshot_df)
+    new_watermark = None
+    for batch in query_batches(sql, job_config, label="historic_drugs"):
+        if batch.num_rows == 0:
+            continue
+        batch_watermark = pc.max(batch.column("last_year_month")).as_py()
+        new_watermark = batch_watermark if new_watermark is None else max(new_watermark, batch_watermark)
+        accumulator.add(batch_to_dataframe(batch.select(columns), string_dtype))
+    df = bsa_utils.convert_string_columns(accumulator.result().reindex(columns=columns), string_dtype)
+
+    if update_snapshot and new_watermark is not None and snapshot.save(df, new_watermark):
+        logging.info(f"Historic snapshot saved with {len(df)} rows up to {int(new_watermark)}.")
     return df
 
-def retrieve_historic_drugs_scmd(before_year_month: str | int) -> pd.DataFrame:
+def retrieve_description_versions(before_year_month: str | int, after_year_month: int | None = None) -> pd.DataFrame:
+    """
+    Return each distinct (BNF_CODE, BNF_DESCRIPTION, CHEMICAL_SUBSTANCE_BNF_DESCR)
+    with the first and last YEAR_MONTH it was prescribed, for months after
+    after_year_month (if given) and before before_year_month.
+    """
+    s = str(before_year_month).strip()
+    if not re.fullmatch(r"\d{6}", s):
+        raise ValueError("before_year_month must be a 6-digit string or int like 202506")
+
+    sql = """
+        SELECT
+            BNF_CODE,
+            BNF_DESCRIPTION,
+            CHEMICAL_SUBSTANCE_BNF_DESCR,
+            MIN(year_month) AS first_month,
+            MAX(year_month) AS last_month
+        FROM (
+            SELECT
+                *,
+                SAFE_CAST(REGEXP_REPLACE(YEAR_MONTH, r'[^0-9]', '') AS INT64) AS year_month
+            FROM `ebmdatalab.hscic.raw_prescribing_v2`
+        )
+        WHERE year_month < @cutoff
+          AND year_month > @after
+        GROUP BY 1, 2, 3
+    """
+
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ScalarQueryParameter("cutoff", "INT64", int(s)),
+            bigquery.ScalarQueryParameter("after", "INT64", after_year_month if after_year_month is not None else 0),
+        ]
+    )
+    return query_to_dataframe(sql, job_config, label="description_versions")
+
+def retrieve_new_epd_values(latest_df: pd.DataFrame, before_year_month: str | int) -> dict:
+    """
+    Find the latest month's BNF codes, descriptions and chemical substances
+    that never appear in BigQuery before before_year_month. The latest distinct
+    values are sent as array parameters and anti-joined against history in
+    BigQuery, so only the new values are downloaded.
+    Returns a dict of column name -> set of new values. Null values are not
+    sent, as BigQuery arrays cannot hold NULL.
+    """
+    s = str(before_year_month).strip()
+    if not re.fullmatch(r"\d{6}", s):
+        raise ValueError("before_year_month must be a 6-digit string or int like 202506")
+    cutoff = int(s)
+
+    columns = {
+        "BNF_CODE": "bnf_codes",
+        "BNF_DESCRIPTION": "bnf_descriptions",
+        "CHEMICAL_SUBSTANCE_BNF_DESCR": "chemical_substances",
+    }
+
+    # History is referenced once and unpivoted, so the table is scanned a single time
+    sql = """
+        WITH latest AS (
+            SELECT 'BNF_CODE' AS column_name, value FROM UNNEST(@bnf_codes) AS value
+            UNION ALL
+            SELECT 'BNF_DESCRIPTION' AS column_name, value FROM UNNEST(@bnf_descriptions) AS value
+            UNION ALL
+            SELECT 'CHEMICAL_SUBSTANCE_BNF_DESCR' AS column_name, value FROM UNNEST(@chemical_substances) AS value
+        ),
+        history AS (
+            SELECT DISTINCT item.column_name, item.value
+            FROM `ebmdatalab.hscic.raw_prescribing_v2`,
+                UNNEST([
+                    STRUCT('BNF_CODE' AS column_name, BNF_CODE AS value),
+                    STRUCT('BNF_DESCRIPTION' AS column_name, BNF_DESCRIPTION AS value),
+                    STRUCT('CHEMICAL_SUBSTANCE_BNF_DESCR' AS column_name, CHEMICAL_SUBSTANCE_BNF_DESCR AS value)
+                ]) AS item
+            WHERE SAFE_CAST(REGEXP_REPLACE(YEAR_MONTH, r'[^0-9]', '') AS INT64) < @cutoff
+        )
+        SELECT latest.column_name, latest.value
+        FROM latest
+        WHERE NOT EXISTS (
+            SELECT 1
+            FROM history
+            WHERE history.column_name = latest.column_name
+              AND history.value = latest.value
+        )
+    """
+
+    query_parameters = [bigquery.ScalarQueryParameter("cutoff", "INT64", cutoff)]
+    for column, parameter in columns.items():
+        values = sorted(str(value) for value in latest_df[column].dropna().unique())
+        query_parameters.append(bigquery.ArrayQueryParameter(parameter, "STRING", values))
+
+    job_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
+    df = query_to_dataframe(sql, job_config, label="new_epd_values")
+
+    new_values = {column: set() for column in columns}
+    for column_name, value in zip(df["column_name"], df["value"]):
+        new_values[column_name].add(value)
+    logging.info(
+        "New values found in BigQuery: "
+        + ", ".join(f"{column}={len(values)}" for column, values in new_values.items())
+    )
+    return new_values
+
+def retrieve_historic_drugs_scmd(before_year_month: str | int, string_dtype: str = "object") -> pd.DataFrame:
     """
     Return distinct drug rows from BigQuery where YEAR_MONTH < before_year_month.
     Reads credentials from bq-service-account.json and returns a pandas DataFrame.
+    string_dtype selects "object", "pyarrow" or "category" string columns.
     """
 
     # Normalise and validate the cutoff like 'YYYYMM'
@@ -63,17 +401,15 @@ def retrieve_historic_drugs_scmd(before_year_month: str | int) -> pd.DataFrame:
 
     cutoff = f"{s[:4]}-{s[4:6]}-01"
 
-    client = make_bq_client()
-
     sql = """
         SELECT DISTINCT
-            vmp_snomed_code,
+            SAFE_CAST(vmp_snomed_code AS INT64) AS vmp_snomed_code,
             vmp_product_name
         FROM `ebmdatalab.scmd_pipeline.scmd_raw_provisional`
         WHERE year_month < @cutoff
         UNION DISTINCT
         SELECT DISTINCT
-            vmp_snomed_code,
+            SAFE_CAST(vmp_snomed_code AS INT64) AS vmp_snomed_code,
             vmp_product_name
         FROM `ebmdatalab.scmd_pipeline.scmd_raw_finalised`
         WHERE year_month < @cutoff
@@ -83,35 +419,148 @@ def retrieve_historic_drugs_scmd(before_year_month: str | int) -> pd.DataFrame:
         query_parameters=[bigquery.ScalarQueryParameter("cutoff", "DATE", cutoff)]
     )
 
-    df = client.query(sql, job_config=job_config).to_dataframe()
-    return df
+    # The query is already distinct, so batches are only converted as they arrive
+    frames = [batch_to_dataframe(batch, string_dtype) for batch in query_batches(sql, job_config, label="historic_drugs_scmd")]
+    if not frames:
+        frames = [pd.DataFrame({"vmp_snomed_code": pd.Series(dtype="Int64"), "vmp_product_name": pd.Series(dtype=object)})]
+    return bsa_utils.convert_string_columns(pd.concat(frames, ignore_index=True), string_dtype)
 
-def join_vtms(existing_df, latest_df):
-    client = make_bq_client()
+class VmpVtmIndex:
+    """
+    Persisted dm+d VMP -> VTM lookup. Only VMP codes missing from the index are
+    queried from BigQuery, in bounded batches, and the whole index is rebuilt
+    once it is older than refresh_after_days so renamed VTMs are picked up.
+    Codes dm+d does not know are stored with no VTM, so each is looked up at
+    most once between rebuilds. VMP and VTM ids are kept as Int64.
+    """
+    columns = ["id", "vtm_id", "vtm_nm"]
 
-    unique_vmp_codes = list(
-        set(existing_df['vmp_snomed_code']).union(set(latest_df['vmp_snomed_code']))
-    )
+    def __init__(self, index_dir=None, batch_size=10000, refresh_after_days=28):
+        index_dir = index_dir if index_dir else os.path.join(bsa_utils.CONFIG_OBJ.DATA_DIR, "dmd")
+        self.store = bsa_utils.ParquetStore(index_dir, "vmp_vtm_index")
+        self.batch_size = batch_size
+        self.refresh_after_days = refresh_after_days
+        self.table = self.empty_table()
+        self.built_at = None
+        self.load()
 
-    sql = """
-        SELECT CAST(vmp.id AS STRING) AS id, CAST(vtm.id AS STRING) AS vtm_id, vtm.nm AS vtm_nm
-        FROM `ebmdatalab.dmd.vmp` vmp
-        LEFT JOIN `ebmdatalab.dmd.vtm` vtm ON vmp.vtm = vtm.id
-        WHERE CAST(vmp.id AS STRING) IN UNNEST(@vmp_codes)
-    """
+    @classmethod
+    def empty_table(cls):
+        return pd.DataFrame({
+            "id": pd.Series(dtype="Int64"),
+            "vtm_id": pd.Series(dtype="Int64"),
+            "vtm_nm": pd.Series(dtype=object),
+        })
 
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ArrayQueryParameter("vmp_codes", "STRING", unique_vmp_codes)
-        ]
-    )
+    def load(self):
+        table, meta = self.store.load()
+        if table is None:
+            return
+        if not pd.api.types.is_integer_dtype(table["id"]):
+            logging.info("VMP -> VTM index has string ids, rebuilding.")
+            return
+        if "built_at" not in meta:
+            return
+        self.built_at = datetime.fromisoformat(meta["built_at"])
+        if datetime.now() - self.built_at > timedelta(days=self.refresh_after_days):
+            logging.info("VMP -> VTM index is due a refresh, rebuilding.")
+            self.built_at = None
+            return
+        self.table = table
+
+    def save(self):
+        self.store.save(self.table, {"built_at": self.built_at.isoformat(timespec="seconds"), "rows": len(self.table)})
+
+    @staticmethod
+    def codes_as_keys(codes):
+        """
+        VMP codes as Int64. Numeric columns are converted directly, except
+        floats above 2**53, which may no longer be the exact id. Strings are
+        trimmed and parsed exactly rather than via float64; anything that is
+        not a plain run of digits becomes <NA>, as SAFE_CAST does on the
+        BigQuery side.
+        """
+        if pd.api.types.is_integer_dtype(codes):
+            return codes.astype("Int64")
+        if pd.api.types.is_float_dtype(codes):
+            whole = np.isfinite(codes) & (codes == np.floor(codes)) & (codes.abs() <= 2**53)
+            dropped = int((codes.notna() & ~whole).sum())
+            keys = codes.where(whole).astype("Int64")
+        else:
+            text = pc.utf8_trim_whitespace(pa.array(codes.astype("string"), from_pandas=True, type=pa.string()))
+            # SNOMED ids are at most 18 digits, so every match fits in int64
+            digits = pc.fill_null(pc.match_substring_regex(text, r"^[0-9]{1,18}$"), False)
+            dropped = int(pc.sum(pc.and_(pc.is_valid(text), pc.invert(digits))).as_py() or 0)
+            parsed = pc.cast(pc.if_else(digits, text, pa.scalar(None, pa.string())), pa.int64())
+            keys = pd.Series(
+                parsed.to_pandas(types_mapper={pa.int64(): pd.Int64Dtype()}.get),
+                index=codes.index, name=codes.name
+            )
+        if dropped:
+            logging.warning(f"Ignoring {dropped} VMP code(s) that are not valid SNOMED ids.")
+        return keys
+
+    def update(self, codes):
+        """
+        Query dm+d for any codes not yet in the index and add them, recording
+        codes it does not return as misses.
+        """
+        codes = pd.Index(pd.unique(codes.dropna()))
+        missing = [int(code) for code in codes[~codes.isin(self.table["id"])]]
+        if not missing:
+            return
+
+        sql = """
+            SELECT vmp.id AS id, vtm.id AS vtm_id, vtm.nm AS vtm_nm
+            FROM `ebmdatalab.dmd.vmp` vmp
+            LEFT JOIN `ebmdatalab.dmd.vtm` vtm ON vmp.vtm = vtm.id
+            WHERE vmp.id IN UNNEST(@vmp_codes)
+        """
+
+        logging.info(f"Looking up {len(missing)} new VMP code(s) in dm+d.")
+        found = []
+        for start in range(0, len(missing), self.batch_size):
+            job_config = bigquery.QueryJobConfig(
+                query_parameters=[
+                    bigquery.ArrayQueryParameter("vmp_codes", "INT64", missing[start:start + self.batch_size])
+                ]
+            )
+            found.append(query_to_dataframe(sql, job_config, label="vmp_vtm_lookup"))
+
+        found = [df.astype({"id": "Int64", "vtm_id": "Int64"}) for df in found]
+        misses = self.empty_table()
+        misses["id"] = pd.array(missing, dtype="Int64")
+        self.table = pd.concat([self.table, misses] + found, ignore_index=True).drop_duplicates(subset="id", keep="last")
+        if self.built_at is None:
+            self.built_at = datetime.now()
+        self.save()
+
+    def join(self, df):
+        # Vectorised lookups against the index rather than a merge per frame
+        lookup = self.table.set_index("id")
+        keys = self.codes_as_keys(df["vmp_snomed_code"])
+        df = df.copy()
+        # Codes that could not be parsed are kept as given for the report
+        invalid = (df["vmp_snomed_code"].notna() & keys.isna()).to_numpy()
+        df["invalid_vmp_snomed_code"] = pd.Series(None, index=df.index, dtype=object)
+        df.loc[invalid, "invalid_vmp_snomed_code"] = df.loc[invalid, "vmp_snomed_code"].astype(str).str.strip()
+        df["vmp_snomed_code"] = keys
+        df["vtm_id"] = keys.map(lookup["vtm_id"]).astype("Int64")
+        df["vtm_nm"] = keys.map(lookup["vtm_nm"])
+        return df
 
-    df = client.query(sql, job_config=job_config).to_dataframe()
+def join_vtms(existing_df, latest_df, string_dtype="object"):
+    # existing_df may be None when only the latest month needs its VTMs
+    index = VmpVtmIndex()
+    frames = [df for df in (existing_df, latest_df) if df is not None]
+    codes = pd.concat([
+        VmpVtmIndex.codes_as_keys(df['vmp_snomed_code']) for df in frames
+    ], ignore_index=True)
+    index.update(codes)
 
-    existing_df = existing_df.merge(df, left_on='vmp_snomed_code', right_on='id', how='left')
-    existing_df.drop(columns=['id'], inplace=True)
-    latest_df = latest_df.merge(df, left_on='vmp_snomed_code', right_on='id', how='left')
-    latest_df.drop(columns=['id'], inplace=True)
+    if existing_df is not None:
+        existing_df = bsa_utils.convert_string_columns(index.join(existing_df), string_dtype)
+    latest_df = bsa_utils.convert_string_columns(index.join(latest_df), string_dtype)
 
     return existing_df, latest_df
 
@@ -0,0 +1,189 @@
+import os
+import re
+import json
+import base64
+import hashlib
+import bisect
+import logging
+import configparser
+from datetime import datetime
+from functools import lru_cache
+from string import Template
+
+# Read the configuration from config.ini
+config = configparser.ConfigParser()
+config.read('src/config.ini')
+
+assets_dir = config['DEFAULT'].get('assets_dir', 'assets').strip()
+embed_assets = config['DEFAULT'].getboolean('embed_assets', False)
+
+EPD_LOGO = "base64_image.txt"
+SCMD_LOGO = "base64_image_oph.txt"
+REPORT_CSS = "report.css"
+LIST_CSS = "report_list.css"
+
+_report_file_re = re.compile(r'^(\w+)_(\d{4}-\d{2})\.html$')
+_embedded_image_re = re.compile(r'src="data:image/(\w+);base64,([A-Za-z0-9+/=\s]+)"')
+
+# Layout shared by every report and index page
+PAGE = Template("""
+    <html>
+    <head>
+    <title>$title</title>
+    $style
+    </head>
+    <body>
+    <div class="container">
+        <header>
+            <img src="$logo" alt="OpenPrescribing logo">
+            <h2>$title</h2>
+        </header>
+$body
+    </div>
+    </body>
+    </html>
+    """)
+
+def decode_base64(encoded):
+    # The stored logos omit the trailing padding, which browsers tolerate
+    encoded = "".join(encoded.split())
+    return base64.b64decode(encoded + "=" * (-len(encoded) % 4))
+
+@lru_cache(maxsize=None)
+def read_asset(name):
+    # Assets are read from src once per process
+    with open(os.path.join(os.getcwd(), "src", name), "r") as file:
+        return file.read()
+
+def write_asset(reports_dir, stem, extension, data):
+    """
+    Write data to the reports' assets directory under a name derived from its
+    content, so a changed logo or stylesheet never alters older reports, and
+    return the path to link to from a report.
+    """
+    name = f"{stem}-{hashlib.sha256(data).hexdigest()[:12]}.{extension}"
+    path = os.path.join(reports_dir, assets_dir, name)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", "wb") as file:
+            file.write(data)
+        os.replace(f"{path}.tmp", path)
+        logging.info(f"Wrote report asset {path}")
+    return f"{assets_dir}/{name}"
+
+@lru_cache(maxsize=None)
+def logo_src(reports_dir, logo):
+    data_uri = read_asset(logo).strip()
+    if embed_assets:
+        return data_uri
+    image_type, encoded = data_uri.split(";base64,", 1)
+    return write_asset(reports_dir, "logo", image_type.split("/")[-1], decode_base64(encoded))
+
+@lru_cache(maxsize=None)
+def style_tag(reports_dir, stylesheet):
+    css = read_asset(stylesheet)
+    if embed_assets:
+        return f"<style>\n{css}    </style>"
+    href = write_asset(reports_dir, os.path.splitext(stylesheet)[0], "css", css.encode("utf-8"))
+    return f'<link rel="stylesheet" href="{href}">'
+
+def render_page(reports_dir, title, body, logo=EPD_LOGO, stylesheet=REPORT_CSS):
+    return PAGE.substitute(
+        title=title,
+        style=style_tag(reports_dir, stylesheet),
+        logo=logo_src(reports_dir, logo),
+        body=body,
+    )
+
+class ReportManifest:
+    """
+    JSON record of the monthly reports published in a reports directory, by
+    report kind, in month order. A new month is appended to its kind, so the
+    index pages and the up-to-date check never list the directory or parse
+    file names. A missing manifest is rebuilt from the directory once.
+    """
+    def __init__(self, reports_dir, file_name="reports_manifest.json"):
+        self.reports_dir = reports_dir
+        self.path = os.path.join(reports_dir, file_name)
+        self.reports = self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as file:
+                return json.load(file)["reports"]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Rebuilding unreadable report manifest {self.path}: {e}")
+        return self.bootstrap()
+
+    def bootstrap(self):
+        self.reports = {}
+        file_names = os.listdir(self.reports_dir) if os.path.isdir(self.reports_dir) else []
+        for file_name in sorted(file_names, key=lambda name: name.split("_")[-1]):
+            match = _report_file_re.match(file_name)
+            if match and not file_name.startswith("list_"):
+                self.add(match.group(1), match.group(2), file_name, save=False)
+        if self.reports:
+            self.save()
+            logging.info(f"Built report manifest {self.path} from {sum(map(len, self.reports.values()))} reports.")
+        return self.reports
+
+    def save(self):
+        os.makedirs(self.reports_dir, exist_ok=True)
+        with open(f"{self.path}.tmp", "w") as file:
+            json.dump({"reports": self.reports}, file, indent=2)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def add(self, kind, month, file_name, save=True):
+        entry = {"month": month, "file": file_name, "title": datetime.strptime(month, "%Y-%m").strftime("%B %Y")}
+        entries = self.reports.setdefault(kind, [])
+        if not entries or entries[-1]["month"] < month:
+            entries.append(entry)
+        else:
+            # Rerun or backfilled month
+            months = [existing["month"] for existing in entries]
+            position = bisect.bisect_left(months, month)
+            if position < len(entries) and months[position] == month:
+                entries[position] = entry
+            else:
+                entries.insert(position, entry)
+        if save:
+            self.save()
+
+    def entries(self, kind):
+        return self.reports.get(kind, [])
+
+    def latest(self, kind):
+        entries = self.entries(kind)
+        return entries[-1]["month"] if entries else None
+
+@lru_cache(maxsize=None)
+def report_manifest(reports_dir):
+    # One manifest per reports directory per process
+    return ReportManifest(reports_dir)
+
+def externalise_images(reports_dir):
+    """
+    Replace logos embedded as base64 in already published reports with links to
+    shared copies in the assets directory.
+    """
+    for file_name in sorted(os.listdir(reports_dir)):
+        file_path = os.path.join(reports_dir, file_name)
+        if not file_name.endswith(".html") or not os.path.isfile(file_path):
+            continue
+        with open(file_path, "r", encoding="utf-8") as file:
+            content = file.read()
+        updated = _embedded_image_re.sub(
+            lambda match: f'src="{write_asset(reports_dir, "logo", match.group(1), decode_base64(match.group(2)))}"',
+            content
+        )
+        if updated != content:
+            with open(file_path, "w", encoding="utf-8") as file:
+                file.write(updated)
+            print(f"Processed file: {file_name}")
+
+if __name__ == "__main__":
+    for reports_dir in ("reports", "scmd_reports"):
+        if os.path.isdir(reports_dir):
+            externalise_images(os.path.join(os.getcwd(), reports_dir))
@@ -4,6 +4,8 @@ import json
 import requests
 from bs4 import BeautifulSoup
 import configparser
+from utils import BNFPrefixIndex
+import template_utils
 
 # Read the configuration from config.ini
 config = configparser.ConfigParser()
@@ -188,25 +190,39 @@ def read_json_files_in_github():
 def wildcard_to_regex(pattern):
     return pattern.replace('%', '.*')
 
+# A pattern whose only wildcard is a trailing '%' is a plain BNF code prefix
+def wildcard_to_prefix(pattern):
+    prefix = pattern[:-1]
+    return prefix if pattern.endswith('%') and prefix.isalnum() else None
+
+# Match BNF codes against wildcard patterns, using the prefix index where possible
+def match_bnf_codes(df, patterns, bnf_index):
+    mask = pd.Series(False, index=df.index)
+    prefixes = []
+    for pattern in patterns:
+        prefix = wildcard_to_prefix(pattern)
+        if prefix is None:
+            mask |= df['BNF_CODE'].str.contains(wildcard_to_regex(pattern), na=False)
+        else:
+            prefixes.append(prefix)
+    if prefixes:
+        mask |= bnf_index.mask(prefixes)
+    return mask
+
 # Filter the DataFrame based on include and exclude lists
-def filter_include_exclude_dataframe(df, testing_include, testing_exclude):
-    # Create a boolean mask for include patterns
-    include_mask = pd.Series(False, index=df.index)
-    for pattern in testing_include:
-        regex_pattern = wildcard_to_regex(pattern)
-        include_mask |= df['BNF_CODE'].str.contains(regex_pattern)
-
-    # Create a boolean mask for exclude patterns
-    exclude_mask = pd.Series(False, index=df.index)
-    for pattern in testing_exclude:
-        regex_pattern = wildcard_to_regex(pattern)
-        exclude_mask |= df['BNF_CODE'].str.contains(regex_pattern)
+def filter_include_exclude_dataframe(df, testing_include, testing_exclude, bnf_index=None):
+    if bnf_index is None:
+        bnf_index = BNFPrefixIndex(df['BNF_CODE'])
+
+    # Create boolean masks for include and exclude patterns
+    include_mask = match_bnf_codes(df, testing_include, bnf_index)
+    exclude_mask = match_bnf_codes(df, testing_exclude, bnf_index)
 
     # Filter DataFrame: include and not exclude
     filtered_df = df[include_mask & ~exclude_mask]
     return filtered_df    
 
-def filter_num_bnf_codes_dataframe(df, testing_data):
+def filter_num_bnf_codes_dataframe(df, testing_data, bnf_index=None):
     # Using list comprehension to remove everything from ' # ' onwards
     cleaned_data = [item.split(' # ')[0] for item in testing_data]
 
@@ -219,27 +235,13 @@ def filter_num_bnf_codes_dataframe(df, testing_data):
     # Creating the exclude list by including items starting with '~' and removing the '~'
     exclude_list = [item[1:] for item in cleaned_data if item.startswith('~')]
 
-    # Create a boolean mask for include patterns
-    include_mask = pd.Series(False, index=df.index)
-    for pattern in include_list:
-        regex_pattern = wildcard_to_regex(pattern)
-        include_mask |= df['BNF_CODE'].str.contains(regex_pattern)
-
-    # Create a boolean mask for exclude patterns
-    exclude_mask = pd.Series(False, index=df.index)
-    for pattern in exclude_list:
-        regex_pattern = wildcard_to_regex(pattern)
-        exclude_mask |= df['BNF_CODE'].str.contains(regex_pattern)
-
-    # Filter DataFrame: include and not exclude
-    filtered_df = df[include_mask & ~exclude_mask]
-    return filtered_df    
+    return filter_include_exclude_dataframe(df, include_list, exclude_list, bnf_index)
 
-def measures_filter(df, measure_data):
+def measures_filter(df, measure_data, bnf_index=None):
     if (measure_data['testing_type'] == 'custom'):
-        filtered_df = filter_include_exclude_dataframe(df, measure_data['testing_include'], measure_data['testing_exclude'])
+        filtered_df = filter_include_exclude_dataframe(df, measure_data['testing_include'], measure_data['testing_exclude'], bnf_index)
     elif (measure_data['testing_type'] == "numerator_bnf_codes_filter"):
-        filtered_df = filter_num_bnf_codes_dataframe(df, measure_data['testing_type_data'])
+        filtered_df = filter_num_bnf_codes_dataframe(df, measure_data['testing_type_data'], bnf_index)
     else:
         print (f"Unknown testing type {measure_data['testing_type']}")
 
@@ -269,94 +271,10 @@ def write_monthly_testing_report_html(triggered_tests, passed_tests, testing_fal
             f'<a href="https://www.nhsbsa.nhs.uk/bnf-code-changes-january-{date[:4]}">more information here</a></p>'
         )
 
-    # Read the base64 image string from the file
-    image_path = os.path.join(os.getcwd(), "src", "base64_image.txt")
-    with open(image_path, "r") as file:
-        base64_image = file.read()
-
     tick_svg = '<span class="svg-icon"><svg xmlns="http://www.w3.org/2000/svg" fill="#15b01a" class="bi bi-check-lg" viewBox="0 0 16 16"><path d="M12.736 3.97a.733.733 0 0 1 1.047 0c.286.289.29.756.01 1.05L7.88 12.01a.733.733 0 0 1-1.065.02L3.217 8.384a.757.757 0 0 1 0-1.06.733.733 0 0 1 1.047 0l3.052 3.093 5.4-6.425z"/></svg></span>'
     question_svg = '<span class="svg-icon"><svg xmlns="http://www.w3.org/2000/svg" fill="#f97306" class="bi bi-question-lg" viewBox="0 0 16 16"><path fill-rule="evenodd" d="M4.475 5.458c-.284 0-.514-.237-.47-.517C4.28 3.24 5.576 2 7.825 2c2.25 0 3.767 1.36 3.767 3.215 0 1.344-.665 2.288-1.79 2.973-1.1.659-1.414 1.118-1.414 2.01v.03a.5.5 0 0 1-.5.5h-.77a.5.5 0 0 1-.5-.495l-.003-.2c-.043-1.221.477-2.001 1.645-2.712 1.03-.632 1.397-1.135 1.397-2.028 0-.979-.758-1.698-1.926-1.698-1.009 0-1.71.529-1.938 1.402-.066.254-.278.461-.54.461h-.777ZM7.496 14c.622 0 1.095-.474 1.095-1.09 0-.618-.473-1.092-1.095-1.092-.606 0-1.087.474-1.087 1.091S6.89 14 7.496 14"/></svg></span>'
     # Start the HTML report
     report = f"""
-    <html>
-    <head>
-    <title>Monthly Testing Report for {date}</title>
-    <style>
-        body {{
-            font-family: Arial, sans-serif;
-            background-color: #f8f9fa;
-            margin: 20px;
-            color: #333;
-        }}
-        .container {{
-            max-width: 900px;
-            margin: 0 auto;
-            padding: 20px;
-            background-color: white;
-            border-radius: 10px;
-            box-shadow: 0px 2px 5px rgba(0, 0, 0, 0.1);
-        }}
-        header {{
-            text-align: center;
-            margin-bottom: 40px;
-        }}
-        header img {{
-            max-width: 650px;
-            margin-bottom: 10px;
-        }}
-        h2 {{
-            color: #333;
-        }}
-        h3 {{
-            color: #333;
-            margin-top: 30px;
-        }}
-        p {{
-            margin-bottom: 15px;
-        }}
-        table {{
-            width: 100%;
-            border-collapse: collapse;
-            margin-top: 20px;
-            margin-bottom: 20px;
-        }}
-        table, th, td {{
-            border: 1px solid #333;
-        }}
-        th {{
-            background-color: #0485d1;
-            color: white;
-            padding: 10px;
-            text-align: left;
-        }}
-        td {{
-            padding: 8px;
-            text-align: left;
-        }}
-        tr:nth-child(even) {{
-            background-color: #f2f2f2;
-        }}
-        a {{
-            text-decoration: none;
-            color: #0485d1;
-        }}
-        a:hover {{
-            text-decoration: underline;
-        }}
-        .svg-icon {{
-            width: 2em;
-            height: 2em;
-            vertical-align: middle;
-            display: inline-block;
-        }}
-    </style>
-    </head>
-    <body>
-    <div class="container">
-        <header>
-            <img src="{base64_image}" alt="OpenPrescribing logo">
-            <h2>Monthly Testing Report for {date}</h2>
-        </header>
         <p>This report details testing results for OpenPrescribing measures which have the flag testing_measure = true. Items appearing in the English Prescribing Data for {date} that have not previously appeared in the data (from Jan 2014).</p>
         {jan_alert}
         <p><a href="{preview_base_url}https://github.com/ebmdatalab/openprescribing-epd-new/blob/main/reports/list_test_reports.html">View previous reports</a></p>
@@ -390,15 +308,12 @@ def write_monthly_testing_report_html(triggered_tests, passed_tests, testing_fal
                 for item in testing_none:
                     report += f"<p><a href='https://github.com/ebmdatalab/openprescribing/tree/main/openprescribing/measures/definitions/{item['filename']}.json'>{item['filename']}</a></p>"
 
-    report += """
-    </div>
-    </body>
-    </html>
-    """
+    report = template_utils.render_page(reports_dir, f"Monthly Testing Report for {date}", report)
 
     # Write the report to a file
     with open(f"{reports_dir}/monthly_test_report_{date}.html", "w") as file:
         file.write(report)
+    template_utils.report_manifest(reports_dir).add("monthly_test_report", date, f"monthly_test_report_{date}.html")
 
     print(f"Report written to {reports_dir}/monthly_testing_report_{date}.html")
 
@@ -406,91 +321,17 @@ def write_monthly_testing_report_html(triggered_tests, passed_tests, testing_fal
 
 def generate_list_reports_html():
     reports_dir = os.path.join(os.getcwd(), "reports")
-    
-    # Read the base64 image string from the file
-    image_path = os.path.join(os.getcwd(), "src", "base64_image.txt")
-    with open(image_path, "r") as file:
-        base64_image = file.read()
-
-    # Get all HTML files in the directory, except list_reports.html
-    html_files = [f for f in os.listdir(reports_dir) if f.endswith('.html') and f != 'list_reports.html' and f != 'list_test_reports.html' and f.startswith('monthly_test_report')]
-
-    # Start the HTML content with the Base64 logo embedded in the header
-    html_content = f"""
-    <html>
-    <head>
-    <title>English Prescribing Data - Monthly Test Reports</title>
-    <style>
-        body {{
-            font-family: Arial, sans-serif;
-            background-color: #f8f9fa;
-            margin: 20px;
-        }}
-        a {{
-            text-decoration: none;
-            color: #0485d1;
-        }}
-        a:hover {{
-            text-decoration: underline;
-        }}
-        h2 {{
-            color: #333;
-        }}
-        li {{
-            margin: 10px 0;
-        }}
-        header {{
-            text-align: center;
-            margin-bottom: 40px;
-        }}
-        header img {{
-            max-width: 650px;
-            margin-bottom: 10px;
-        }}
-        .container {{
-            max-width: 800px;
-            margin: 0 auto;
-            padding: 20px;
-            background-color: white;
-            border-radius: 10px;
-            box-shadow: 0px 2px 5px rgba(0, 0, 0, 0.1);
-        }}
-    </style>
-    </head>
-    <body>
-    <div class="container">
-        <header>
-            <img src="{base64_image}" alt="OpenPrescribing logo">
-            <h2>English Prescribing Data - Monthly Test Reports</h2>
-        </header>
-        <ul>
-    """
 
-    # Function to extract the date portion (YYYY-MM) for sorting
-    def extract_date(filename):
-        # Split by underscores and get the last part, then remove '.html'
-        date_part = filename.split('_')[-1].replace('.html', '')
-        return date_part
-
-    # Sort the list using the extracted date as the key so the index page appears in correct order
-    html_files = sorted(html_files, key=extract_date)
-
-    # Add links to all HTML files
-    for html_file in html_files:
-        title = os.path.splitext(html_file)[0]
-        # Create title for month and year
-        title = title.split('_')[-1]
-        title = pd.to_datetime(title).strftime('%B %Y')
-        link = f"{preview_base_url}https://github.com/ebmdatalab/openprescribing-epd-new/blob/main/reports/{html_file}"
-        html_content += f'<li><a href="{link}">{title}</a></li>\n'
-
-    # End the HTML content
-    html_content += """
-    </ul>
-    </div>
-    </body>
-    </html>
-    """
+    # Published test reports, in month order, from the manifest
+    items = []
+    for entry in template_utils.report_manifest(reports_dir).entries("monthly_test_report"):
+        link = f"{preview_base_url}https://github.com/ebmdatalab/openprescribing-epd-new/blob/main/reports/{entry['file']}"
+        items.append(f'<li><a href="{link}">{entry["title"]}</a></li>\n')
+
+    html_content = template_utils.render_page(
+        reports_dir, "English Prescribing Data - Monthly Test Reports",
+        f"        <ul>\n{''.join(items)}    </ul>", stylesheet=template_utils.LIST_CSS
+    )
 
     # Write the HTML content to list_reports.html
     with open(os.path.join(reports_dir, 'list_test_reports.html'), 'w') as f:
@@ -509,8 +350,11 @@ def run_tests(bnf_codes_df, date_for):
     triggered_tests = []
     passed_tests = []
 
+    # One prefix index over the new codes serves every measure
+    bnf_index = BNFPrefixIndex(bnf_codes_df['BNF_CODE'])
+
     for measure_data in testing_true:
-        test_result = measures_filter(bnf_codes_df, measure_data)
+        test_result = measures_filter(bnf_codes_df, measure_data, bnf_index)
         if (test_result["test_triggered"]):
             triggered_tests.append(test_result)
         else:
@@ -1,7 +1,13 @@
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import os
 import configparser
 import re
+from string import Template
+from concurrent.futures import ThreadPoolExecutor
+import template_utils
 
 # Read the configuration from config.ini
 config = configparser.ConfigParser()
@@ -26,62 +32,237 @@ def _alphanum_key(s):
             key.append((2, p))           # punctuation/other -> lowest precedence among non-numeric/alpha
     return tuple(key)
 
+def _bnf_key(code):
+    """Return tuple key for a BNF / product code (see CompareLatest.sort_by_bnf_code)."""
+    s = '' if code is None or code is pd.NA else str(code)
+    prefix6 = s[:6]
+    if len(prefix6) == 6 and prefix6.isdigit():
+        return (0, int(prefix6[:2]), int(prefix6[2:4]), int(prefix6[4:6]), _alphanum_key(s[6:]))
+    if s.isdigit():
+        return (1, int(s))
+    return (2, _alphanum_key(s))
+
+# the same tokens as _token_re, grouped by class
+_packed_token_re = re.compile(r'(\d+)|([A-Za-z]+)|([^A-Za-z0-9]+)')
+
+def _packed_alphanum_key(s):
+    """Return _alphanum_key(s) packed into a string with the same ordering, or None."""
+    packed = []
+    for digits, letters, other in _packed_token_re.findall(s):
+        if digits:
+            # length-prefixed so shorter numbers sort first, as ints do
+            digits = digits.lstrip('0')
+            if len(digits) > 99:
+                return None
+            packed.append('0%02d%s' % (len(digits), digits))
+        elif letters:
+            packed.append('1' + letters.upper() + '\x01')  # terminator sorts below any printable character
+        else:
+            packed.append('2' + other + '\x01')
+    return ''.join(packed)
+
+def _packed_bnf_key(code):
+    """
+    Return _bnf_key(code) packed into bytes whose plain byte order matches the
+    tuple order, or None for odd (non-printable or non-ASCII) codes.
+    """
+    s = '' if code is None or code is pd.NA else str(code)
+    if not (s.isascii() and s.isprintable()):
+        return None
+    if len(s) >= 6 and s[:6].isdigit():
+        # chapter, section and paragraph are fixed width, so their digits pack as-is
+        tail = _packed_alphanum_key(s[6:])
+        packed = None if tail is None else '0' + s[:6] + tail
+    elif s.isdigit():
+        digits = s.lstrip('0')
+        packed = '1%02d%s' % (len(digits), digits)
+    else:
+        tail = _packed_alphanum_key(s)
+        packed = None if tail is None else '2' + tail
+    return None if packed is None else packed.encode('ascii')
+
+def _arrow_values(series):
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        # Only the categories in use, without decoding every row
+        codes = series.cat.codes.to_numpy()
+        used = np.flatnonzero(np.bincount(codes[codes >= 0], minlength=len(series.cat.categories)))
+        values = pa.array(series.cat.categories.take(used), from_pandas=True)
+        if (codes < 0).any():
+            values = pa.concat_arrays([values, pa.nulls(1, values.type)])
+        return values
+    values = pa.array(series, from_pandas=True)
+    if isinstance(values, pa.ChunkedArray):
+        values = values.combine_chunks()
+    return values
+
+def only_in_latest_mask(latest, existing):
+    """
+    Boolean mask of the values in latest that do not appear anywhere in
+    existing. latest is factorized into integer codes and existing is probed
+    once against the distinct latest values, so both sides share the same
+    codes and the large historic column is never turned into a Python set.
+    Columns Arrow cannot convert fall back to pandas' factorize and isin.
+    """
+    if isinstance(latest.dtype, pd.CategoricalDtype):
+        codes = latest.cat.codes.to_numpy()
+        category_mask = only_in_latest_mask(pd.Series(latest.cat.categories), existing)
+        mask = np.empty(len(codes), dtype=bool)
+        mask[codes >= 0] = category_mask[codes[codes >= 0]]
+        mask[codes < 0] = not existing.isna().any()
+        return mask
+    try:
+        latest_values = _arrow_values(latest)
+        existing_values = _arrow_values(existing)
+        if latest_values.type == pa.null():
+            # An all-null latest column has no type of its own to compare in
+            latest_values = latest_values.cast(existing_values.type)
+        elif existing_values.type != latest_values.type:
+            existing_values = existing_values.cast(latest_values.type)
+        encoded = pc.dictionary_encode(latest_values, null_encoding="encode")
+        # Position of each existing value among the distinct latest values
+        positions = pc.index_in(existing_values, value_set=encoded.dictionary).drop_null()
+        seen = np.bincount(positions.to_numpy(), minlength=len(encoded.dictionary)) > 0
+        return ~seen[encoded.indices.to_numpy(zero_copy_only=False)]
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        codes, uniques = pd.factorize(latest, use_na_sentinel=False)
+        return ~pd.Index(uniques).isin(existing)[codes]
+
+class BNFPrefixIndex:
+    """
+    Sorted index of the distinct BNF codes in a column, answering "rows under
+    chapter/section/paragraph X, except Y" with binary searches.
+    """
+    def __init__(self, codes):
+        row_codes, uniques = pd.factorize(pd.Series(codes).astype(object))
+        uniques = np.asarray(uniques, dtype=str)
+        order = np.argsort(uniques, kind='stable')
+        self.sorted_codes = uniques[order]
+        ranks = np.empty(len(order), dtype=np.int64)
+        ranks[order] = np.arange(len(order))
+        # Missing codes take rank -1, which never matches a prefix
+        if len(ranks) == 0:
+            self.row_ranks = np.full(len(row_codes), -1, dtype=np.int64)
+        else:
+            self.row_ranks = np.where(row_codes >= 0, ranks[np.maximum(row_codes, 0)], -1)
+
+    def code_range(self, prefix):
+        # Every code starting with prefix sorts between these two bounds
+        low = np.searchsorted(self.sorted_codes, prefix, side='left')
+        high = np.searchsorted(self.sorted_codes, prefix + '\U0010ffff', side='left')
+        return low, high
+
+    def prefix_mask(self, prefixes):
+        covered = np.zeros(len(self.sorted_codes) + 1, dtype=np.int64)
+        for prefix in prefixes:
+            low, high = self.code_range(prefix)
+            covered[low] += 1
+            covered[high] -= 1
+        # Trailing False is looked up by missing codes (rank -1)
+        code_mask = np.append(np.cumsum(covered[:-1]) > 0, False)
+        return code_mask[self.row_ranks]
+
+    def mask(self, prefixes, except_prefixes=()):
+        """
+        Boolean mask of the rows whose code starts with any of prefixes and
+        with none of except_prefixes.
+        """
+        mask = self.prefix_mask(prefixes)
+        if except_prefixes:
+            mask &= ~self.prefix_mask(except_prefixes)
+        return mask
+
+class SeenKeys:
+    """
+    Distinct values of each key column seen so far, so that consecutive months
+    can be compared without re-reading history. Each month's new values are
+    found against the seen values and then added to them.
+    """
+    def __init__(self, df, columns):
+        self.columns = columns
+        self.seen = {column: pd.Series(pd.unique(df[column].astype(object)), dtype=object) for column in columns}
+
+    def new_values(self, df):
+        new_values = {}
+        for column in self.columns:
+            mask = only_in_latest_mask(df[column], self.seen[column])
+            new_values[column] = set(pd.unique(df[column][mask].astype(object)))
+        return new_values
+
+    def add(self, new_values):
+        for column in self.columns:
+            values = pd.Series(list(new_values.get(column, ())), dtype=object)
+            self.seen[column] = pd.concat([self.seen[column], values], ignore_index=True)
+
 class CompareLatest:
-    def __init__(self, df_existing, df_latest, exclude_chapters=[]):
+    KEY_COLUMNS = ['BNF_CODE', 'BNF_DESCRIPTION', 'CHEMICAL_SUBSTANCE_BNF_DESCR']
+
+    def __init__(self, df_existing, df_latest, exclude_chapters=[], new_values=None, parallel=False, description_index=None, report_month=None):
+        """
+        new_values optionally maps each key column to the set of values already
+        known to be new (e.g. computed in BigQuery), in which case df_existing
+        may be None. With parallel=True the key columns are compared in
+        separate threads. description_index (a match_utils.DescriptionIndex)
+        adds the closest existing descriptions to the new descriptions table,
+        limited to descriptions first seen before report_month (YYYYMM).
+        """
         self.df_existing = df_existing
         self.df_latest = df_latest
         self.exclude_chapters = exclude_chapters
+        self.new_values = new_values
+        self.parallel = parallel
+        self.description_index = description_index
+        self.report_month = report_month
+        self.masks = {}
         self.new_chem_subs = None
         self.new_bnf_codes = None
         self.new_bnf_descriptions = None
         if self.exclude_chapters:
-            self.df_existing = self.exclude_these_chapters(self.df_existing, self.exclude_chapters)
+            if self.df_existing is not None:
+                self.df_existing = self.exclude_these_chapters(self.df_existing, self.exclude_chapters)
             self.df_latest = self.exclude_these_chapters(self.df_latest, self.exclude_chapters)
+        self.find_masks_only_in_latest()
         self.find_bnf_code_only_in_latest()
         self.find_bnf_description_only_in_latest()
         self.find_chemical_substance_bnf_descr_only_in_latest()
         self.new_desc_only = self.find_unique_rows(self.new_bnf_descriptions, self.new_bnf_codes)
 
-    def find_bnf_code_only_in_latest(self):
-        latest_codes = set(self.df_latest['BNF_CODE'])
-        existing_codes = set(self.df_existing['BNF_CODE'])
-        unique_codes = latest_codes - existing_codes
+    def mask_only_in_latest(self, column):
+        latest = self.df_latest[column]
+        if self.new_values is not None:
+            return latest.isin(list(self.new_values.get(column, ()))).to_numpy()
+        return only_in_latest_mask(latest, self.df_existing[column])
+
+    def find_masks_only_in_latest(self):
+        # The key columns are independent, so they can be compared concurrently
+        if self.parallel:
+            with ThreadPoolExecutor(max_workers=len(self.KEY_COLUMNS)) as executor:
+                masks = list(executor.map(self.mask_only_in_latest, self.KEY_COLUMNS))
+        else:
+            masks = [self.mask_only_in_latest(column) for column in self.KEY_COLUMNS]
+        self.masks = dict(zip(self.KEY_COLUMNS, masks))
 
-        result = self.df_latest[self.df_latest['BNF_CODE'].isin(unique_codes)]
-        self.new_bnf_codes = result
+    def rows_only_in_latest(self, column):
+        return self.df_latest[self.masks[column]]
 
-    def find_bnf_description_only_in_latest(self):
-        latest_descriptions = set(self.df_latest['BNF_DESCRIPTION'])
-        existing_descriptions = set(self.df_existing['BNF_DESCRIPTION'])
-        unique_descriptions = latest_descriptions - existing_descriptions
+    def find_bnf_code_only_in_latest(self):
+        self.new_bnf_codes = self.rows_only_in_latest('BNF_CODE')
 
-        result = self.df_latest[self.df_latest['BNF_DESCRIPTION'].isin(unique_descriptions)]
-        self.new_bnf_descriptions = result
+    def find_bnf_description_only_in_latest(self):
+        self.new_bnf_descriptions = self.rows_only_in_latest('BNF_DESCRIPTION')
 
     def find_chemical_substance_bnf_descr_only_in_latest(self):
-        latest_substances = set(self.df_latest['CHEMICAL_SUBSTANCE_BNF_DESCR'])
-        existing_substances = set(self.df_existing['CHEMICAL_SUBSTANCE_BNF_DESCR'])
-        unique_substances = latest_substances - existing_substances
-
-        result = self.df_latest[self.df_latest['CHEMICAL_SUBSTANCE_BNF_DESCR'].isin(unique_substances)]
-        self.new_chem_subs = result
+        self.new_chem_subs = self.rows_only_in_latest('CHEMICAL_SUBSTANCE_BNF_DESCR')
 
     @staticmethod
     def exclude_these_chapters(df, codes):
-        # Separate codes starting with '~' and others
-        exclude_codes = [code for code in codes if not code.startswith('~')]
-        except_codes = [code[1:] for code in codes if code.startswith('~')]
-
-        # Copy the DataFrame to avoid modifying the original
-        df = df.copy()
-
-        # Filter out rows based on the conditions
-        condition_exclude_2 = df['BNF_CODE'].str[:2].isin(exclude_codes)
-        condition_exclude_4 = df['BNF_CODE'].str[:4].isin(exclude_codes)
-        condition_except = df['BNF_CODE'].str[:4].isin(except_codes)
+        # Separate codes starting with '~' and others. Exclusions apply to
+        # chapters (2 characters) and sections (4), exceptions to sections.
+        exclude_codes = [code for code in codes if not code.startswith('~') and len(code) in (2, 4)]
+        except_codes = [code[1:] for code in codes if code.startswith('~') and len(code) == 5]
 
         # Exclude rows meeting the exclude condition but not the except condition
-        df = df[~(condition_exclude_2 | condition_exclude_4) | condition_except]
+        excluded = BNFPrefixIndex(df['BNF_CODE']).mask(exclude_codes, except_codes)
+        df = df[~excluded]
 
         # Reset the index of the resulting DataFrame
         df = df.reset_index(drop=True)
@@ -103,57 +284,68 @@ class CompareLatest:
         3) Otherwise treat as general alphanumeric and use _alphanum_key:
             Key: (2, alphanum_key(code))
         This preserves the BNF hierarchy while correctly ordering numeric product codes and other strings.
-        """
-        df = df.copy()
 
-        cache = {}
-
-        def make_key(code):
-            s = '' if code is None else str(code)
-            if s in cache:
-                return cache[s]
-
-            # attempt: first 6 chars digits -> BNF hierarchy
-            prefix6 = s[:6]
-            if len(prefix6) == 6 and prefix6.isdigit():
-                chap = int(prefix6[:2])
-                sect = int(prefix6[2:4])
-                para = int(prefix6[4:6])
-                tail = s[6:]
-                tail_key = _alphanum_key(tail)
-                key = (0, chap, sect, para, tail_key)
-                cache[s] = key
-                return key
-
-            # numeric-only long product codes (e.g. 20033000572)
-            if s.isdigit():
-                key = (1, int(s))
-                cache[s] = key
-                return key
-
-            # fallback: general alphanumeric
-            key = (2, _alphanum_key(s))
-            cache[s] = key
-            return key
-
-        df['_sort_key'] = df['BNF_CODE'].map(make_key)
+        Each distinct code is packed once into a byte string with the same
+        ordering as this key, so rows are ordered by a stable NumPy argsort
+        rather than by comparing tuples. Odd codes that cannot be packed fall
+        back to the tuple keys.
+        """
+        # Map over plain objects so categorical/Arrow-backed codes behave the same
+        codes, uniques = pd.factorize(df['BNF_CODE'].astype(object))
+        # Missing codes (-1) take the last entry and sort as ''
+        uniques = list(uniques) + ['']
+
+        packed = [_packed_bnf_key(code) for code in uniques]
+        if all(key is not None for key in packed):
+            # Dense rank of each distinct code; equal keys share a rank
+            _, ranks = np.unique(np.array(packed, dtype=bytes), return_inverse=True)
+        else:
+            keys = [_bnf_key(code) for code in uniques]
+            ranks = np.empty(len(keys), dtype=np.int64)
+            rank = -1
+            previous = None
+            for index in sorted(range(len(keys)), key=keys.__getitem__):
+                if rank < 0 or keys[index] != previous:
+                    rank += 1
+                    previous = keys[index]
+                ranks[index] = rank
 
         # stable sort to preserve order within equal keys
-        df = df.sort_values(by='_sort_key', kind='mergesort').drop(columns=['_sort_key']).reset_index(drop=True)
-        return df
+        order = np.argsort(ranks[codes], kind='stable')
+        return df.iloc[order].reset_index(drop=True)
     
     @staticmethod
-    def find_unique_rows(df1, df2):
-        # Merge the two dataframes with indicator to identify the source of each row
-        merged_df = df1.merge(df2, how='outer', indicator=True)
+    def row_keys(df, key_column='BNF_CODE'):
+        # The key column's hash combined with a fingerprint of the other columns
+        columns = [key_column] + [column for column in df.columns if column != key_column]
+        return pd.Index(pd.util.hash_pandas_object(df[columns], index=False).to_numpy())
 
-        # Select the rows that are only in one of the dataframes
-        unique_rows = merged_df[merged_df['_merge'] != 'both']
-
-        # Drop the indicator column before returning
-        unique_rows = unique_rows.drop(columns=['_merge'])
-
-        return unique_rows
+    @staticmethod
+    def find_unique_rows(df1, df2, key_column='BNF_CODE'):
+        """
+        Rows that appear in only one of the two frames, as an anti-join in each
+        direction on the key column and a fingerprint of the other columns.
+        Rows are returned in the order a full outer merge would give them.
+        """
+        if list(df1.columns) != list(df2.columns) or key_column not in df1.columns:
+            merged_df = df1.merge(df2, how='outer', indicator=True)
+            return merged_df[merged_df['_merge'] != 'both'].drop(columns=['_merge'])
+
+        keys1 = CompareLatest.row_keys(df1, key_column)
+        keys2 = CompareLatest.row_keys(df2, key_column)
+        unique_rows = pd.concat([df1[~keys1.isin(keys2)], df2[~keys2.isin(keys1)]])
+
+        # An outer merge sorts on every column, so match its order. Categoricals
+        # it can join directly (same categories on both sides) sort by code.
+        by_code = [
+            column for column in df1.columns
+            if isinstance(df1[column].dtype, pd.CategoricalDtype) and df1[column].dtype == df2[column].dtype
+        ]
+        return unique_rows.sort_values(
+            by=list(unique_rows.columns),
+            kind='mergesort',
+            key=lambda column: column.cat.codes if column.name in by_code else column.astype(object)
+        ).reset_index(drop=True)
       
     def return_new_chem_subs(self):
         return self.sort_by_bnf_code(self.new_chem_subs)
@@ -164,29 +356,63 @@ class CompareLatest:
     def return_new_bnf_descriptions(self):
         return self.sort_by_bnf_code(self.new_bnf_descriptions)
     
+    def add_closest_descriptions(self, df):
+        df = df.copy()
+        matches = self.description_index.closest(df['BNF_DESCRIPTION'].astype(object), before_month=self.report_month)
+        df['CLOSEST_EXISTING_DESCRIPTIONS'] = [
+            '; '.join(f"{description} ({similarity:.0%})" for description, similarity in match)
+            for match in matches
+        ]
+        return df
+
     def return_new_desc_only(self):
-        return self.sort_by_bnf_code(self.new_desc_only)
+        df = self.sort_by_bnf_code(self.new_desc_only)
+        if self.description_index is not None:
+            df = self.add_closest_descriptions(df)
+        return df
 
 class CompareLatestSCMD:
-    def __init__(self, df_existing, df_latest):
+    KEY_COLUMNS = ['vmp_snomed_code', 'vtm_id']
+
+    def __init__(self, df_existing, df_latest, new_values=None):
+        """
+        new_values optionally maps each key column to the set of values already
+        known to be new, in which case df_existing may be None.
+        """
         self.df_existing = df_existing
         self.df_latest = df_latest
+        self.new_values = new_values
         self.new_vtms = None
         self.new_vmps = None
+        self.invalid_vmps = None
         self.find_vmp_only_in_latest()
         self.find_vtm_only_in_latest()
+        self.find_invalid_vmps()
+
+    def mask_only_in_latest(self, column):
+        # Codes are Int64, so these are vectorised integer set differences
+        latest = self.df_latest[column]
+        if self.new_values is not None:
+            mask = latest.isin([value for value in self.new_values.get(column, ()) if pd.notna(value)]).to_numpy()
+        else:
+            mask = only_in_latest_mask(latest, self.df_existing[column])
+        return mask & latest.notna().to_numpy()
 
     def find_vmp_only_in_latest(self):
-        latest = set(self.df_latest['vmp_snomed_code'])
-        existing = set(self.df_existing['vmp_snomed_code'])
-        unique = latest - existing
-        self.new_vmps = self._sort(self.df_latest[self.df_latest['vmp_snomed_code'].isin(unique)])
+        self.new_vmps = self._sort(self.df_latest[self.mask_only_in_latest('vmp_snomed_code')])
 
     def find_vtm_only_in_latest(self):
-        latest = set(self.df_latest['vtm_id'].dropna())
-        existing = set(self.df_existing['vtm_id'].dropna())
-        unique = latest - existing
-        self.new_vtms = self._sort(self.df_latest[self.df_latest['vtm_id'].isin(unique)])
+        self.new_vtms = self._sort(self.df_latest[self.mask_only_in_latest('vtm_id')])
+
+    def find_invalid_vmps(self):
+        # Rows whose code is not a SNOMED id cannot be compared, so list them all
+        if 'invalid_vmp_snomed_code' not in self.df_latest:
+            self.invalid_vmps = self.df_latest.iloc[:0]
+            return
+        invalid = self.df_latest[self.df_latest['invalid_vmp_snomed_code'].notna()]
+        self.invalid_vmps = invalid[['invalid_vmp_snomed_code', 'vmp_product_name']].drop_duplicates().sort_values(
+            ['vmp_product_name', 'invalid_vmp_snomed_code'], na_position='last'
+        ).reset_index(drop=True)
 
     @staticmethod
     def _sort(df):
@@ -196,317 +422,112 @@ class CompareLatestSCMD:
         ).reset_index(drop=True)
 
     def return_new_vmps(self):
-        return self.new_vmps
+        return self.new_vmps.drop(columns='invalid_vmp_snomed_code', errors='ignore')
 
     def return_new_vtms(self):
-        return self.new_vtms
-
-def write_monthly_report_html(chem_subs, bnf_codes, bnf_descriptions, date):
-    reports_dir = os.path.join(os.getcwd(), "reports")
-    os.makedirs(reports_dir, exist_ok=True)
+        return self.new_vtms.drop(columns='invalid_vmp_snomed_code', errors='ignore')
 
-    image_path = os.path.join(os.getcwd(), "src", "base64_image.txt")
-    with open(image_path, "r") as file:
-        base64_image = file.read()
-
-    # Create an alert if January data to explain BNF structure changes
-    if date[-2:] == '01':
-        jan_alert = f'<p><b>Please note:</b> January data often includes a larger number of "changes" as BNF structure changes are generally made in January data - <a href="https://www.nhsbsa.nhs.uk/bnf-code-changes-january-{date[:4]}">more information here</a></p>'
-    else:
-        jan_alert = ''
+    def return_invalid_vmps(self):
+        return self.invalid_vmps
 
-    # Write a function to generate the HTML report
-    report = f"""
-    <html>
-    <head>
-    <title>Monthly New Item Report for {date}</title>
-    <style>
-        body {{
-            font-family: Arial, sans-serif;
-            background-color: #f8f9fa;
-            margin: 20px;
-            color: #333;
-        }}
-        .container {{
-            max-width: 900px;
-            margin: 0 auto;
-            padding: 20px;
-            background-color: white;
-            border-radius: 10px;
-            box-shadow: 0px 2px 5px rgba(0, 0, 0, 0.1);
-        }}
-        header {{
-            text-align: center;
-            margin-bottom: 40px;
-        }}
-        header img {{
-            max-width: 650px;
-            margin-bottom: 10px;
-        }}
-        h2 {{
-            color: #333;
-        }}
-        h3 {{
-            color: #333;
-            margin-top: 30px;
-        }}
-        p {{
-            margin-bottom: 15px;
-        }}
-        table {{
-            width: 100%;
-            border-collapse: collapse;
-            margin-top: 20px;
-            margin-bottom: 20px;
-        }}
-        table, th, td {{
-            border: 1px solid #333;
-        }}
-        th {{
-            background-color: #0485d1;
-            color: white;
-            padding: 10px;
-            text-align: left;
-        }}
-        td {{
-            padding: 8px;
-            text-align: left;
-        }}
-        tr:nth-child(even) {{
-            background-color: #f2f2f2;
-        }}
-        a {{
-            text-decoration: none;
-            color: #0485d1;
-        }}
-        a:hover {{
-            text-decoration: underline;
-        }}
-    </style>
-    </head>
-    <body>
-    <div class="container">
-        <header>
-            <img src="{base64_image}" alt="OpenPrescribing logo">
-            <h2>Monthly New Item Report for {date}</h2>
-        </header>
-        <p>This report details items appearing in the English Prescribing Data for {date} that have not previously appeared in the data (from Jan 2014).</p>
-        {jan_alert}
-        <p><a href="{preview_base_url}url=https://github.com/ebmdatalab/openprescribing-epd-new/blob/main/reports/list_reports.html">View previous reports</a></p>
+MONTHLY_REPORT = Template("""
+        <p>This report details items appearing in the English Prescribing Data for $date that have not previously appeared in the data (from Jan 2014).</p>
+        $jan_alert
+        <p><a href="${preview_base_url}url=https://github.com/ebmdatalab/openprescribing-epd-new/blob/main/reports/list_reports.html">View previous reports</a></p>
         
         <h3>New Chemical Substances</h3>
         <p>Identify "chemical substances" prescribed for the first time</p>
-        {chem_subs.to_html(index=False, classes='table')}
+        $chem_subs
         
         <h3>New BNF Codes</h3>
         <p>Identify BNF codes used for the first time</p>
-        {bnf_codes.to_html(index=False, classes='table')}
+        $bnf_codes
         
         <h3>New BNF Descriptions</h3>
         <p>Identify new descriptions only (not new BNF code)</p>
-        {bnf_descriptions.to_html(index=False, classes='table')}
-    </div>
-    </body>
-    </html>
-    """
+        $bnf_descriptions""")
+
+MONTHLY_REPORT_SCMD = Template("""
+        <p>This report details items appearing in the Secondary Care Medicines Data for $date that have not previously appeared in the data.</p>
+        <p><a href="${preview_base_url}url=https://github.com/ebmdatalab/openprescribing-epd-new/blob/main/scmd_reports/list_reports_scmd.html">View previous reports</a></p>
+
+        <h3>New VTMs</h3>
+        <p>Virtual Therapeutic Moieties appearing in SCMD for the first time</p>
+        $vtms
+
+        <h3>New VMPs</h3>
+        <p>Virtual Medicinal Products appearing in SCMD for the first time</p>
+        $vmps
+
+        <h3>Unrecognised VMP Codes</h3>
+        <p>Products whose VMP code is not a valid SNOMED id, so could not be checked against previous data</p>
+        $invalid_vmps""")
+
+def write_monthly_report_html(chem_subs, bnf_codes, bnf_descriptions, date):
+    reports_dir = os.path.join(os.getcwd(), "reports")
+    os.makedirs(reports_dir, exist_ok=True)
+
+    # Create an alert if January data to explain BNF structure changes
+    if date[-2:] == '01':
+        jan_alert = f'<p><b>Please note:</b> January data often includes a larger number of "changes" as BNF structure changes are generally made in January data - <a href="https://www.nhsbsa.nhs.uk/bnf-code-changes-january-{date[:4]}">more information here</a></p>'
+    else:
+        jan_alert = ''
+
+    body = MONTHLY_REPORT.substitute(
+        date=date,
+        jan_alert=jan_alert,
+        preview_base_url=preview_base_url,
+        chem_subs=chem_subs.to_html(index=False, classes='table'),
+        bnf_codes=bnf_codes.to_html(index=False, classes='table'),
+        bnf_descriptions=bnf_descriptions.to_html(index=False, classes='table'),
+    )
+    report = template_utils.render_page(reports_dir, f"Monthly New Item Report for {date}", body)
 
     # Write the report to a file
     with open(f"{reports_dir}/monthly_report_{date}.html", "w") as file:
         file.write(report)
+    template_utils.report_manifest(reports_dir).add("monthly_report", date, f"monthly_report_{date}.html")
 
     print(f"Report written to {reports_dir}/monthly_report_{date}.html")
 
 def generate_list_reports_html():
     reports_dir = os.path.join(os.getcwd(), "reports")
-    
-    # Read the base64 image string from the file
-    image_path = os.path.join(os.getcwd(), "src", "base64_image.txt")
-    with open(image_path, "r") as file:
-        base64_image = file.read()
-
-    # Get all HTML files in the directory, except list_reports.html
-    html_files = [f for f in os.listdir(reports_dir) if f.endswith('.html') and f != 'list_reports.html' and f != 'list_test_reports.html' and not f.startswith('monthly_test_report')]
-
-    # Start the HTML content with the Base64 logo embedded in the header
-    html_content = f"""
-    <html>
-    <head>
-    <title>English Prescribing Data - Monthly New Items Reports</title>
-    <style>
-        body {{
-            font-family: Arial, sans-serif;
-            background-color: #f8f9fa;
-            margin: 20px;
-        }}
-        a {{
-            text-decoration: none;
-            color: #0485d1;
-        }}
-        a:hover {{
-            text-decoration: underline;
-        }}
-        h2 {{
-            color: #333;
-        }}
-        li {{
-            margin: 10px 0;
-        }}
-        header {{
-            text-align: center;
-            margin-bottom: 40px;
-        }}
-        header img {{
-            max-width: 650px;
-            margin-bottom: 10px;
-        }}
-        .container {{
-            max-width: 800px;
-            margin: 0 auto;
-            padding: 20px;
-            background-color: white;
-            border-radius: 10px;
-            box-shadow: 0px 2px 5px rgba(0, 0, 0, 0.1);
-        }}
-    </style>
-    </head>
-    <body>
-    <div class="container">
-        <header>
-            <img src="{base64_image}" alt="OpenPrescribing logo">
-            <h2>English Prescribing Data - Monthly New Items Reports</h2>
-        </header>
-        <ul>
-    """
 
-    # Function to extract the date portion (YYYY-MM) for sorting
-    def extract_date(filename):
-        # Split by underscores and get the last part, then remove '.html'
-        date_part = filename.split('_')[-1].replace('.html', '')
-        return date_part
-
-    # Sort the list using the extracted date as the key so the index page appears in correct order
-    html_files = sorted(html_files, key=extract_date)
-
-    # Add links to all HTML files
-    for html_file in html_files:
-        title = os.path.splitext(html_file)[0]
-        # Create title for month and year
-        title = title.split('_')[-1]
-        title = pd.to_datetime(title).strftime('%B %Y')
-        link = f"{preview_base_url}https://github.com/ebmdatalab/openprescribing-epd-new/blob/main/reports/{html_file}"
-        html_content += f'<li><a href="{link}">{title}</a></li>\n'
-
-    # End the HTML content
-    html_content += """
-    </ul>
-    </div>
-    </body>
-    </html>
-    """
+    # Published reports, in month order, from the manifest
+    items = []
+    for entry in template_utils.report_manifest(reports_dir).entries("monthly_report"):
+        link = f"{preview_base_url}https://github.com/ebmdatalab/openprescribing-epd-new/blob/main/reports/{entry['file']}"
+        items.append(f'<li><a href="{link}">{entry["title"]}</a></li>\n')
+
+    html_content = template_utils.render_page(
+        reports_dir, "English Prescribing Data - Monthly New Items Reports",
+        f"        <ul>\n{''.join(items)}    </ul>", stylesheet=template_utils.LIST_CSS
+    )
 
     # Write the HTML content to list_reports.html
     with open(os.path.join(reports_dir, 'list_reports.html'), 'w') as f:
         f.write(html_content)
 
-def write_monthly_report_html_scmd(vtms, vmps, date):
+def write_monthly_report_html_scmd(vtms, vmps, date, invalid_vmps=None):
     reports_dir = os.path.join(os.getcwd(), "scmd_reports")
     os.makedirs(reports_dir, exist_ok=True)
-
-    image_path = os.path.join(os.getcwd(), "src", "base64_image_oph.txt")
-    with open(image_path, "r") as file:
-        base64_image = file.read()
-
-    report = f"""
-    <html>
-    <head>
-    <title>Monthly New Item Report (SCMD) for {date}</title>
-    <style>
-        body {{
-            font-family: Arial, sans-serif;
-            background-color: #f8f9fa;
-            margin: 20px;
-            color: #333;
-        }}
-        .container {{
-            max-width: 900px;
-            margin: 0 auto;
-            padding: 20px;
-            background-color: white;
-            border-radius: 10px;
-            box-shadow: 0px 2px 5px rgba(0, 0, 0, 0.1);
-        }}
-        header {{
-            text-align: center;
-            margin-bottom: 40px;
-        }}
-        header img {{
-            max-width: 650px;
-            margin-bottom: 10px;
-        }}
-        h2 {{
-            color: #333;
-        }}
-        h3 {{
-            color: #333;
-            margin-top: 30px;
-        }}
-        p {{
-            margin-bottom: 15px;
-        }}
-        table {{
-            width: 100%;
-            border-collapse: collapse;
-            margin-top: 20px;
-            margin-bottom: 20px;
-        }}
-        table, th, td {{
-            border: 1px solid #333;
-        }}
-        th {{
-            background-color: #0485d1;
-            color: white;
-            padding: 10px;
-            text-align: left;
-        }}
-        td {{
-            padding: 8px;
-            text-align: left;
-        }}
-        tr:nth-child(even) {{
-            background-color: #f2f2f2;
-        }}
-        a {{
-            text-decoration: none;
-            color: #0485d1;
-        }}
-        a:hover {{
-            text-decoration: underline;
-        }}
-    </style>
-    </head>
-    <body>
-    <div class="container">
-        <header>
-            <img src="{base64_image}" alt="OpenPrescribing logo">
-            <h2>Monthly New Item Report (SCMD) for {date}</h2>
-        </header>
-        <p>This report details items appearing in the Secondary Care Medicines Data for {date} that have not previously appeared in the data.</p>
-        <p><a href="{preview_base_url}url=https://github.com/ebmdatalab/openprescribing-epd-new/blob/main/scmd_reports/list_reports_scmd.html">View previous reports</a></p>
-
-        <h3>New VTMs</h3>
-        <p>Virtual Therapeutic Moieties appearing in SCMD for the first time</p>
-        {vtms.to_html(index=False, classes='table')}
-
-        <h3>New VMPs</h3>
-        <p>Virtual Medicinal Products appearing in SCMD for the first time</p>
-        {vmps.to_html(index=False, classes='table')}
-    </div>
-    </body>
-    </html>
-    """
+    if invalid_vmps is None:
+        invalid_vmps = pd.DataFrame(columns=['invalid_vmp_snomed_code', 'vmp_product_name'])
+
+    body = MONTHLY_REPORT_SCMD.substitute(
+        date=date,
+        preview_base_url=preview_base_url,
+        vtms=vtms.to_html(index=False, classes='table'),
+        vmps=vmps.to_html(index=False, classes='table'),
+        invalid_vmps=invalid_vmps.to_html(index=False, classes='table'),
+    )
+    report = template_utils.render_page(
+        reports_dir, f"Monthly New Item Report (SCMD) for {date}", body, logo=template_utils.SCMD_LOGO
+    )
 
     with open(f"{reports_dir}/monthly_report_scmd_{date}.html", "w") as file:
         file.write(report)
+    template_utils.report_manifest(reports_dir).add("monthly_report_scmd", date, f"monthly_report_scmd_{date}.html")
 
     print(f"Report written to {reports_dir}/monthly_report_scmd_{date}.html")
 
@@ -514,83 +535,16 @@ def write_monthly_report_html_scmd(vtms, vmps, date):
 def generate_list_reports_html_scmd():
     reports_dir = os.path.join(os.getcwd(), "scmd_reports")
 
-    image_path = os.path.join(os.getcwd(), "src", "base64_image_oph.txt")
-    with open(image_path, "r") as file:
-        base64_image = file.read()
-
-    html_files = [
-        f for f in os.listdir(reports_dir)
-        if f.endswith('.html') and f != 'list_reports_scmd.html'
-    ]
-
-    def extract_date(filename):
-        date_part = filename.split('_')[-1].replace('.html', '')
-        return date_part
-
-    html_files = sorted(html_files, key=extract_date)
-
-    html_content = f"""
-    <html>
-    <head>
-    <title>Secondary Care Medicines Data - Monthly New Items Reports</title>
-    <style>
-        body {{
-            font-family: Arial, sans-serif;
-            background-color: #f8f9fa;
-            margin: 20px;
-        }}
-        a {{
-            text-decoration: none;
-            color: #0485d1;
-        }}
-        a:hover {{
-            text-decoration: underline;
-        }}
-        h2 {{
-            color: #333;
-        }}
-        li {{
-            margin: 10px 0;
-        }}
-        header {{
-            text-align: center;
-            margin-bottom: 40px;
-        }}
-        header img {{
-            max-width: 650px;
-            margin-bottom: 10px;
-        }}
-        .container {{
-            max-width: 800px;
-            margin: 0 auto;
-            padding: 20px;
-            background-color: white;
-            border-radius: 10px;
-            box-shadow: 0px 2px 5px rgba(0, 0, 0, 0.1);
-        }}
-    </style>
-    </head>
-    <body>
-    <div class="container">
-        <header>
-            <img src="{base64_image}" alt="OpenPrescribing logo">
-            <h2>Secondary Care Medicines Data - Monthly New Items Reports</h2>
-        </header>
-        <ul>
-    """
+    items = []
+    for entry in template_utils.report_manifest(reports_dir).entries("monthly_report_scmd"):
+        link = f"{preview_base_url}https://github.com/ebmdatalab/openprescribing-epd-new/blob/main/scmd_reports/{entry['file']}"
+        items.append(f'<li><a href="{link}">{entry["title"]}</a></li>\n')
 
-    for html_file in html_files:
-        title = os.path.splitext(html_file)[0].split('_')[-1]
-        title = pd.to_datetime(title).strftime('%B %Y')
-        link = f"{preview_base_url}https://github.com/ebmdatalab/openprescribing-epd-new/blob/main/scmd_reports/{html_file}"
-        html_content += f'<li><a href="{link}">{title}</a></li>\n'
-
-    html_content += """
-        </ul>
-    </div>
-    </body>
-    </html>
-    """
+    html_content = template_utils.render_page(
+        reports_dir, "Secondary Care Medicines Data - Monthly New Items Reports",
+        f"        <ul>\n{''.join(items)}        </ul>",
+        logo=template_utils.SCMD_LOGO, stylesheet=template_utils.LIST_CSS
+    )
 
     with open(os.path.join(reports_dir, 'list_reports_scmd.html'), 'w') as f:
-        f.write(html_content)
\ No newline at end of file
+        f.write(html_content)
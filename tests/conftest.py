@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The modules under src import each other by name and read src/config.ini
+# relative to the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+os.chdir(ROOT)
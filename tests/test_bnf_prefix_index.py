@@ -0,0 +1,22 @@
+import numpy as np
+import pandas as pd
+from hypothesis import given, settings, strategies as st
+import utils
+
+codes = st.lists(st.one_of(st.none(), st.text(alphabet="0123AB", max_size=6)), max_size=20)
+prefixes = st.lists(st.text(alphabet="0123AB", min_size=1, max_size=4), max_size=4)
+
+def startswith_mask(values, prefixes, except_prefixes):
+    def matches(value, options):
+        return value is not None and any(value.startswith(option) for option in options)
+    return np.array([matches(value, prefixes) and not matches(value, except_prefixes) for value in values], dtype=bool)
+
+@settings(max_examples=500, deadline=None)
+@given(codes, prefixes, prefixes)
+def test_mask_matches_startswith(values, include, exclude):
+    result = utils.BNFPrefixIndex(values).mask(include, exclude)
+    np.testing.assert_array_equal(result, startswith_mask(values, include, exclude))
+
+def test_all_null_codes_match_nothing():
+    for values in ([None], [None, None], pd.Series([None], dtype="string[pyarrow]")):
+        assert not utils.BNFPrefixIndex(values).mask(["01"], ["0101"]).any()
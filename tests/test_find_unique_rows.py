@@ -0,0 +1,58 @@
+import pandas as pd
+from hypothesis import given, settings, strategies as st
+import bsa_utils
+import utils
+
+COLUMNS = ["BNF_CODE", "BNF_DESCRIPTION", "CHEMICAL_SUBSTANCE_BNF_DESCR"]
+
+values = st.sampled_from(["a", "b", "B", "c", "0101", "01011", "0101010A0AAAAAA", None])
+rows = st.lists(st.tuples(values, values, values), max_size=12)
+string_dtypes = st.sampled_from(["object", "pyarrow", "category"])
+
+def merge_unique_rows(df1, df2):
+    # The original implementation: an outer merge on every column
+    merged_df = df1.merge(df2, how='outer', indicator=True)
+    return merged_df[merged_df['_merge'] != 'both'].drop(columns=['_merge'])
+
+def assert_same_rows(df1, df2):
+    expected = merge_unique_rows(df1, df2).astype(object).reset_index(drop=True)
+    result = utils.CompareLatest.find_unique_rows(df1, df2).astype(object).reset_index(drop=True)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+    pd.testing.assert_frame_equal(
+        utils.CompareLatest.sort_by_bnf_code(result),
+        utils.CompareLatest.sort_by_bnf_code(expected),
+        check_dtype=False
+    )
+
+@settings(max_examples=300, deadline=None)
+@given(rows, rows, string_dtypes)
+def test_matches_outer_merge_for_separate_frames(rows1, rows2, string_dtype):
+    # Each frame converted on its own, so categoricals have different categories
+    df1 = bsa_utils.convert_string_columns(pd.DataFrame(rows1, columns=COLUMNS, dtype=object), string_dtype)
+    df2 = bsa_utils.convert_string_columns(pd.DataFrame(rows2, columns=COLUMNS, dtype=object), string_dtype)
+    assert_same_rows(df1, df2)
+
+@settings(max_examples=300, deadline=None)
+@given(rows, string_dtypes, st.integers(min_value=1, max_value=3), st.integers(min_value=1, max_value=3))
+def test_matches_outer_merge_for_slices_of_one_frame(latest_rows, string_dtype, step1, step2):
+    # As in CompareLatest, where both frames are selections of the latest extract
+    latest = bsa_utils.convert_string_columns(pd.DataFrame(latest_rows, columns=COLUMNS, dtype=object), string_dtype)
+    assert_same_rows(latest.iloc[::step1], latest.iloc[1::step2])
+
+def test_keeps_duplicate_rows_and_nulls():
+    df1 = pd.DataFrame([("0101", "a", None), ("0101", "a", None), ("0202", None, "c")], columns=COLUMNS)
+    df2 = pd.DataFrame([("0202", None, "c"), ("0303", "b", "c")], columns=COLUMNS)
+    for string_dtype in ["object", "pyarrow", "category"]:
+        assert_same_rows(
+            bsa_utils.convert_string_columns(df1, string_dtype),
+            bsa_utils.convert_string_columns(df2, string_dtype)
+        )
+
+@settings(max_examples=300, deadline=None)
+@given(st.lists(values, max_size=8), st.lists(values, max_size=8))
+def test_only_in_latest_mask_matches_isin(latest_values, existing_values):
+    # Includes all-null columns, which Arrow types as null rather than string
+    latest = pd.Series(latest_values, dtype=object)
+    existing = pd.Series(existing_values, dtype=object)
+    expected = ~latest.isin(existing).to_numpy()
+    assert (utils.only_in_latest_mask(latest, existing) == expected).all()